@@ -12,4 +12,12 @@ class DjangoStripeConfig(AppConfig):
         stripe.api_key = settings.STRIPE_SECRET_KEY
         stripe_app_data = settings.STRIPE_APP_DATA
         stripe.set_app_info(**stripe_app_data)
-        from . import signal_receivers
+        if stripe.default_http_client is None:
+            from .deadline import DeadlineRequestsClient
+            stripe.default_http_client = DeadlineRequestsClient(verify_ssl_certs=stripe.verify_ssl_certs,
+                                                                proxy=stripe.proxy)
+        from . import checks, signal_receivers
+        if settings.STRIPE_WARM_UP_ON_STARTUP:
+            from .utils import run_in_background
+            from .warmup import warm_up
+            run_in_background(warm_up)
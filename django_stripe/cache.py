@@ -0,0 +1,160 @@
+import threading
+import time
+
+from collections import OrderedDict
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from .conf import settings
+from .logging import logger
+from typing import Any, Callable, Optional, Tuple
+
+
+class LocalCache:
+    """
+    A thread-safe, in-process cache which holds at most max_size entries, discarding the least recently used.
+    Each entry expires after its own timeout.
+    """
+    def __init__(self):
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, timeout: float, max_size: int):
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    An optional in-process LocalCache in front of a Django cache such as Redis or Memcached.
+    The local tier is enabled by setting settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE.
+    To keep nodes coherent, a generation counter is stored in the Django cache and incremented whenever a key is set
+    or deleted. Each process checks it at most every settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SYNC_SECONDS and clears
+    its local tier when another process has changed it. The expiry time of each key is stored alongside it, so a
+    key is never kept in the local tier for longer than in the Django cache.
+    """
+    def __init__(self, get_shared_cache: Callable[[], BaseCache], generation_key: str):
+        self.get_shared_cache = get_shared_cache
+        self.generation_key = generation_key
+        self.local = LocalCache()
+        self._generation: Optional[int] = None
+        self._generation_checked_at: Optional[float] = None
+
+    @property
+    def local_enabled(self) -> bool:
+        return bool(settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE)
+
+    def _sync_generation(self):
+        now = time.monotonic()
+        if self._generation_checked_at is not None and (
+                now - self._generation_checked_at < settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SYNC_SECONDS):
+            return
+        self._generation_checked_at = now
+        generation = self.get_shared_cache().get(self.generation_key, 0)
+        if generation != self._generation:
+            if self._generation is not None:
+                logger.debug('Cache generation %s changed to %s, clearing local cache', self._generation, generation)
+            self.local.clear()
+            self._generation = generation
+
+    def _expires_at_key(self, key: str) -> str:
+        return f'{key}_expires_at'
+
+    def _set_local(self, key: str, value: Any, timeout: Optional[float]):
+        local_timeout = settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_TIMEOUT_SECONDS
+        if timeout is not None:
+            local_timeout = min(local_timeout, timeout)
+        self.local.set(key, value, local_timeout, settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE)
+
+    def _increment_generation(self) -> int:
+        shared_cache = self.get_shared_cache()
+        try:
+            return shared_cache.incr(self.generation_key)
+        except ValueError:
+            shared_cache.set(self.generation_key, 1, timeout=None)
+            return 1
+
+    def _notify_change(self):
+        """
+        Increment the generation counter so other processes clear their local tier. The local tier of this process
+        is only cleared if another process had changed the generation since it was last checked.
+        """
+        generation = self._increment_generation()
+        if self._generation is None or generation != self._generation + 1:
+            self.local.clear()
+        self._generation = generation
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if not self.local_enabled:
+            return self.get_shared_cache().get(key, default)
+        self._sync_generation()
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        expires_at_key = self._expires_at_key(key)
+        values = self.get_shared_cache().get_many([key, expires_at_key])
+        value = values.get(key)
+        if value is None:
+            return default
+        expires_at = values.get(expires_at_key)
+        self._set_local(key, value, None if expires_at is None else expires_at - time.time())
+        return value
+
+    def set(self, key: str, value: Any, timeout: Optional[float] = DEFAULT_TIMEOUT, notify: bool = True):
+        """
+        Set the key in the Django cache and the local tier.
+        notify may be False when the key was not found in the cache, as no process can have it in its local tier.
+        """
+        shared_cache = self.get_shared_cache()
+        if not self.local_enabled:
+            shared_cache.set(key, value, timeout=timeout)
+            return
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = shared_cache.default_timeout
+        if timeout is None:
+            shared_cache.set(key, value, timeout=None)
+            shared_cache.delete(self._expires_at_key(key))
+        else:
+            shared_cache.set_many({key: value, self._expires_at_key(key): time.time() + timeout}, timeout=timeout)
+        if notify:
+            self._notify_change()
+        self._set_local(key, value, timeout)
+
+    def delete(self, key: str):
+        if not self.local_enabled:
+            self.get_shared_cache().delete(key)
+            return
+        self.get_shared_cache().delete_many([key, self._expires_at_key(key)])
+        self.local.delete(key)
+        self._notify_change()
+
+    def invalidate_local(self):
+        """
+        Clear the local tier on all nodes by incrementing the generation counter.
+        """
+        self._generation = self._increment_generation()
+        self.local.clear()
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import threading
+import time
+import stripe
+import subscriptions
+
+from django.core.cache import caches, cache
+from .conf import settings
+from .logging import logger, p
+from subscriptions.types import ProductDetail, PriceSubscription
+from typing import Any, Callable, Dict, List, Optional
+
+
+class PriceIndex:
+    """
+    In-memory index of active price ids to the product each price belongs to.
+    Allows prices to be validated without a request to the Stripe API.
+    The index is loaded on first use and reloaded once it is older than settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS.
+    Call refresh() when the catalog is changed to reload it immediately.
+    """
+    miss_refresh_interval: int = 30
+
+    def __init__(self):
+        self._prices: Dict[str, str] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load() -> Dict[str, str]:
+        return {price['id']: price['product'] for price in
+                stripe.Price.list(active=True, limit=100).auto_paging_iter()}
+
+    def refresh(self) -> Dict[str, str]:
+        self._prices = self.load()
+        self._loaded_at = time.monotonic()
+        logger.debug('Loaded price index with %s', p.lazy_no('price', len(self._prices)))
+        return self._prices
+
+    def age(self) -> Optional[float]:
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def _refresh_if_older_than(self, seconds: float):
+        """
+        Only one thread reloads the index. Other threads keep using the existing index rather than waiting,
+        unless it has never been loaded.
+        """
+        age = self.age()
+        if age is not None and age < seconds:
+            return
+        if self._lock.acquire(blocking=age is None):
+            try:
+                age = self.age()
+                if age is None or age >= seconds:
+                    self.refresh()
+            finally:
+                self._lock.release()
+
+    def get_product(self, price_id: str) -> Optional[str]:
+        """
+        Return the product id for an active price, or None if the price does not exist or is not active.
+        A price missing from the index may have been created since it was loaded, so the index is reloaded,
+        no more often than every miss_refresh_interval seconds.
+        """
+        self._refresh_if_older_than(settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS)
+        product = self._prices.get(price_id)
+        if product is None:
+            self._refresh_if_older_than(self.miss_refresh_interval)
+            product = self._prices.get(price_id)
+        return product
+
+
+price_index = PriceIndex()
+
+
+def refresh_price_index() -> Dict[str, str]:
+    """
+    Reload the index of allowed prices. Should be called when prices are created, modified or archived.
+    """
+    return price_index.refresh()
+
+
+def _get_catalog_cache() -> cache:
+    """
+    Return the cache to use to store products and prices. Default value is 'default'.
+    """
+    return caches[settings.STRIPE_CATALOG_CACHE_NAME]
+
+
+catalog_version_key = 'django_stripe_catalog_version'
+
+
+def invalidate_catalog():
+    """
+    Invalidate all cached products and prices on all nodes and reload the price index.
+    Should be called when products or prices are created, modified or archived.
+    """
+    catalog_cache = _get_catalog_cache()
+    try:
+        catalog_cache.incr(catalog_version_key)
+    except ValueError:
+        catalog_cache.set(catalog_version_key, 1, timeout=None)
+    refresh_price_index()
+
+
+def _cached(name: str, f: Callable, **kwargs) -> Any:
+    """
+    Return the result of f(**kwargs) from the catalog cache, calling f and storing the result if it is missing.
+    Only data which is the same for all users can be stored here.
+    """
+    timeout = settings.STRIPE_CATALOG_CACHE_TIMEOUT_SECONDS
+    if not timeout:
+        return f(**kwargs)
+    catalog_cache = _get_catalog_cache()
+    version = catalog_cache.get(catalog_version_key, 0)
+    params = hashlib.md5(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()
+    cache_key = f'django_stripe_catalog_{name}_{params}'
+    result = catalog_cache.get(cache_key, version=version)
+    if result is None:
+        logger.debug('Retrieving %s from Stripe with cache key %s', name, cache_key)
+        result = f(**kwargs)
+        catalog_cache.set(cache_key, result, timeout=timeout, version=version)
+    return result
+
+
+product_keys = ('id', 'images', 'type', 'name', 'shippable', 'unit_label', 'url', 'metadata')
+price_keys = ('id', 'recurring', 'type', 'currency', 'unit_amount', 'unit_amount_decimal', 'nickname', 'metadata')
+
+
+def _no_subscription_info() -> Dict[str, Any]:
+    return {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
+
+
+def load_products_and_prices(ids: List[str] = None, price_kwargs: Dict[str, Any] = None,
+                             only_with_prices: bool = False) -> List[ProductDetail]:
+    """
+    List all active prices with their products expanded and group them by product.
+    Prices are listed in a single paginated request to the Stripe API, however many products there are.
+    Active products without active prices matching price_kwargs are then listed in a second paginated request and
+    included with an empty list of prices, unless only_with_prices is True.
+    Products are in the same order as stripe.Product.list, newest first.
+    """
+    products: Dict[str, ProductDetail] = {}
+    created: Dict[str, int] = {}
+
+    def add_product(product: Dict[str, Any]):
+        if product['id'] not in products:
+            products[product['id']] = {**{k: product[k] for k in product_keys}, 'prices': [],
+                                       'subscription_info': _no_subscription_info()}
+            created[product['id']] = product['created']
+
+    for price in stripe.Price.list(**{'limit': 100, **(price_kwargs or {}), 'active': True,
+                                      'expand': ['data.product']}).auto_paging_iter():
+        product = price['product']
+        if not product['active'] or (ids and product['id'] not in ids):
+            continue
+        add_product(product)
+        products[product['id']]['prices'].append(
+            {**{k: price[k] for k in price_keys}, 'subscription_info': _no_subscription_info()})
+    if not only_with_prices:
+        for product in stripe.Product.list(limit=100, active=True, **({'ids': ids} if ids else {})).auto_paging_iter():
+            add_product(product)
+    logger.debug('Loaded %s with %s', p.lazy_no('product', len(products)),
+                 p.lazy_no('price', sum(len(product['prices']) for product in products.values())))
+    return sorted(products.values(), key=lambda product: created[product['id']], reverse=True)
+
+
+def get_products(ids: List[str] = None, price_kwargs: Dict[str, Any] = None, only_with_prices: bool = False,
+                 **kwargs) -> List[ProductDetail]:
+    """
+    Get active products with their prices, without subscription information.
+    kwargs is a list of filters to provide to stripe.Product.list. If none are given, products are loaded with
+    load_products_and_prices. If only_with_prices is True, products without active prices are left out so they are
+    loaded in a single pass over the active prices.
+    """
+    if kwargs:
+        return _cached('products', subscriptions.get_subscription_products_and_prices,
+                       ids=ids, price_kwargs=price_kwargs, **kwargs)
+    return _cached('products', load_products_and_prices, ids=ids, price_kwargs=price_kwargs,
+                   only_with_prices=only_with_prices)
+
+
+def get_prices(**kwargs) -> List[PriceSubscription]:
+    """
+    Get active prices, without subscription information.
+    kwargs is a list of filters to provide to stripe.Price.list as in the Stripe API.
+    """
+    return _cached('prices', subscriptions.get_subscription_prices, **kwargs)
+
+
+def retrieve_product(product_id: str, price_kwargs: Dict[str, Any] = None) -> ProductDetail:
+    """
+    Retrieve a single product with prices, without subscription information.
+    """
+    return _cached('product', subscriptions.retrieve_product, user=None, product_id=product_id,
+                   price_kwargs=price_kwargs)
+
+
+def retrieve_price(price_id: str) -> PriceSubscription:
+    """
+    Retrieve a single price, without subscription information.
+    """
+    return _cached('price', subscriptions.retrieve_price, user=None, price_id=price_id)
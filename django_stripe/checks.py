@@ -0,0 +1,33 @@
+from django.conf import settings as django_settings
+from django.core.checks import Error, Warning, register
+
+from .conf import settings
+from .exceptions import ConfigurationException
+
+
+@register('django_stripe')
+def check_settings(app_configs=None, **kwargs):
+    """
+    Check that the settings needed to use the Stripe API are present and consistent.
+    """
+    messages = []
+    secret_key = settings.STRIPE_SECRET_KEY
+    publishable_key = settings.STRIPE_PUBLISHABLE_KEY
+    if not secret_key:
+        messages.append(Warning('STRIPE_SECRET_KEY is not set.', id='django_stripe.W001'))
+    if not publishable_key:
+        messages.append(Warning('STRIPE_PUBLISHABLE_KEY is not set, so the django_stripe checkout cannot be used.',
+                                id='django_stripe.W002'))
+    if secret_key and publishable_key and ('_test_' in secret_key) != ('_test_' in publishable_key):
+        messages.append(Error('STRIPE_SECRET_KEY and STRIPE_PUBLISHABLE_KEY are not both test mode or both live mode keys.',
+                              id='django_stripe.E003'))
+    try:
+        settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
+    except ConfigurationException:
+        messages.append(Warning('STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID is not set.', id='django_stripe.W004'))
+    for name in ('STRIPE_SUBSCRIPTION_CACHE_NAME', 'STRIPE_CATALOG_CACHE_NAME'):
+        cache_name = getattr(settings, name)
+        if cache_name not in django_settings.CACHES:
+            messages.append(Error(f"{name} is '{cache_name}' but there is no cache with this name in CACHES.",
+                                  id='django_stripe.E005'))
+    return messages
@@ -69,6 +69,13 @@ class Settings:
         """
         return getattr(django_settings, 'STRIPE_KEEP_CUSTOMER_DETAILS_UPDATED', True)
 
+    @property
+    def STRIPE_CREATE_CUSTOMER_ON_SIGNUP(self) -> bool:
+        """
+        Whether to create the Stripe customer in the background as soon as a new user is saved, instead of the first time the user accesses billing.
+        """
+        return getattr(django_settings, 'STRIPE_CREATE_CUSTOMER_ON_SIGNUP', False)
+
     @property
     def STRIPE_NEW_CUSTOMER_GET_KWARGS(self) -> bool:
         """
@@ -150,6 +157,13 @@ class Settings:
         """
         return getattr(django_settings, 'STRIPE_GET_COUNTRY_HEADER ', None)
 
+    @property
+    def STRIPE_USE_USER_SUBSCRIPTION_STATUS(self) -> bool:
+        """
+        If the user model stores subscription status (see django_stripe.models.StripeSubscriptionUser), whether to trust an active subscription stored on the user until its current_period_end or cancel_at, instead of checking with the Stripe API.
+        """
+        return getattr(django_settings, 'STRIPE_USE_USER_SUBSCRIPTION_STATUS', False)
+
     @property
     def STRIPE_SUBSCRIPTION_CACHE_NAME(self) -> Optional[str]:
         """
@@ -160,9 +174,181 @@ class Settings:
     @property
     def STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS(self) -> Optional[str]:
         """
-        How long to store keys in the Stripe Subscription Cache.
+        The longest time to store keys in the Stripe Subscription Cache.
+        Keys for a subscription expire sooner if it reaches cancel_at or current_period_end first.
         """
         return getattr(django_settings, 'STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS', DEFAULT_TIMEOUT)
 
+    @property
+    def STRIPE_SUBSCRIPTION_CACHE_GRACE_SECONDS(self) -> int:
+        """
+        How long after current_period_end a subscription may stay in the Stripe Subscription Cache, to allow time for the renewal to be processed.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_CACHE_GRACE_SECONDS', 0)
+
+    @property
+    def STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS(self) -> int:
+        """
+        Subscription checks for entries in the Stripe Subscription Cache which expire within this many seconds are answered from the cache while the entry is refreshed in the background. 0 disables refreshing ahead.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS', 0)
+
+    @property
+    def STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS(self) -> int:
+        """
+        How long after expiring an entry in the Stripe Subscription Cache can still be used while it is refreshed in the background. Never past the subscription's cancel_at or current_period_end. 0 disables using expired entries.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS', 0)
+
+    @property
+    def STRIPE_PRICE_INDEX_REFRESH_SECONDS(self) -> Optional[int]:
+        """
+        Active prices are kept in an in-memory index so prices can be validated when creating checkouts without a request to the Stripe API.
+        This is how often the index is reloaded. Set to None to disable the index and retrieve the price from Stripe each time.
+        """
+        return getattr(django_settings, 'STRIPE_PRICE_INDEX_REFRESH_SECONDS', 300)
+
+    @property
+    def STRIPE_CATALOG_CACHE_NAME(self) -> str:
+        """
+        Products and prices without subscription information are the same for all users and are cached. This is the cache name to use for storing them.
+        """
+        return getattr(django_settings, 'STRIPE_CATALOG_CACHE_NAME', 'default')
+
+    @property
+    def STRIPE_CATALOG_CACHE_TIMEOUT_SECONDS(self) -> int:
+        """
+        How long to cache products and prices. Also used as the max-age of the Cache-Control header for anonymous users. Set to 0 to disable.
+        """
+        return getattr(django_settings, 'STRIPE_CATALOG_CACHE_TIMEOUT_SECONDS', 300)
+
+    @property
+    def STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE(self) -> int:
+        """
+        Maximum number of entries to keep in an in-process cache in front of the Stripe Subscription Cache. 0 disables the in-process cache.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE', 0)
+
+    @property
+    def STRIPE_SUBSCRIPTION_LOCAL_CACHE_TIMEOUT_SECONDS(self) -> float:
+        """
+        How long to keep entries in the in-process subscription cache. Never longer than the entry is kept in the Stripe Subscription Cache.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_LOCAL_CACHE_TIMEOUT_SECONDS', 30)
+
+    @property
+    def STRIPE_SUBSCRIPTION_LOCAL_CACHE_SYNC_SECONDS(self) -> float:
+        """
+        How often each process checks the generation counter in the Stripe Subscription Cache to see if the in-process cache must be cleared.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_LOCAL_CACHE_SYNC_SECONDS', 1)
+
+    @property
+    def STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS(self) -> int:
+        """
+        How long to cache that a user is not subscribed to a product. 0 disables caching negative results.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS', 0)
+
+    @property
+    def STRIPE_SUBSCRIPTION_REQUIRED_PATHS(self) -> Dict[str, Optional[str]]:
+        """
+        For SubscriptionRequiredMiddleware, a mapping of url path prefixes to the product id required to access them.
+        A product id of None means STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_REQUIRED_PATHS', {})
+
+    @property
+    def STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL(self) -> Optional[str]:
+        """
+        Url, or url name, to redirect to when a user who is not subscribed accesses a page requiring a subscription.
+        If None, a 403 response is returned.
+        """
+        return getattr(django_settings, 'STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL', None)
+
+    @property
+    def STRIPE_DETACH_PAYMENT_METHODS_MAX_WORKERS(self) -> int:
+        """
+        Maximum number of payment methods to detach in parallel when detaching all payment methods for a user.
+        """
+        return getattr(django_settings, 'STRIPE_DETACH_PAYMENT_METHODS_MAX_WORKERS', 4)
+
+    @property
+    def STRIPE_BATCH_MAX_REQUESTS(self) -> int:
+        """
+        Maximum number of sub-requests accepted by the batch API view.
+        """
+        return getattr(django_settings, 'STRIPE_BATCH_MAX_REQUESTS', 10)
+
+    @property
+    def STRIPE_DEADLINE_SECONDS(self) -> Optional[float]:
+        """
+        Default time budget for all the requests to the Stripe API made by a django_stripe view. None means no deadline.
+        """
+        return getattr(django_settings, 'STRIPE_DEADLINE_SECONDS', None)
+
+    @property
+    def STRIPE_ERROR_LOG_RATE_LIMIT(self) -> Optional[int]:
+        """
+        Maximum number of times each kind of Stripe API error is logged per minute by the API views. None logs every error.
+        """
+        return getattr(django_settings, 'STRIPE_ERROR_LOG_RATE_LIMIT', 10)
+
+    @property
+    def STRIPE_USE_OPERATION_QUEUE(self) -> bool:
+        """
+        Whether to queue the update of customer details when a user is saved, to be run by the stripe_worker command, instead of calling the Stripe API during the save.
+        """
+        return getattr(django_settings, 'STRIPE_USE_OPERATION_QUEUE', False)
+
+    @property
+    def STRIPE_OPERATION_MAX_ATTEMPTS(self) -> int:
+        """
+        Number of times a queued Stripe operation is attempted before it is marked as failed.
+        """
+        return getattr(django_settings, 'STRIPE_OPERATION_MAX_ATTEMPTS', 8)
+
+    @property
+    def STRIPE_OPERATION_RETRY_SECONDS(self) -> float:
+        """
+        Delay before the first retry of a queued Stripe operation. The delay doubles with each attempt.
+        """
+        return getattr(django_settings, 'STRIPE_OPERATION_RETRY_SECONDS', 10)
+
+    @property
+    def STRIPE_OPERATION_MAX_RETRY_SECONDS(self) -> float:
+        """
+        Maximum delay between retries of a queued Stripe operation.
+        """
+        return getattr(django_settings, 'STRIPE_OPERATION_MAX_RETRY_SECONDS', 3600)
+
+    @property
+    def STRIPE_WEBHOOK_SECRET(self) -> Optional[str]:
+        """
+        The signing secret of the webhook endpoint as shown in the Stripe Dashboard. Can also be set with an environment variable.
+        """
+        return getattr(django_settings, 'STRIPE_WEBHOOK_SECRET', os.environ.get('STRIPE_WEBHOOK_SECRET'))
+
+    @property
+    def STRIPE_WEBHOOK_PROCESS_IN_BACKGROUND(self) -> bool:
+        """
+        Whether events received by the webhook view are applied in a background thread once they are stored. If False, run the stripe_process_events command instead.
+        """
+        return getattr(django_settings, 'STRIPE_WEBHOOK_PROCESS_IN_BACKGROUND', True)
+
+    @property
+    def STRIPE_WARM_UP_ON_STARTUP(self) -> bool:
+        """
+        Whether to warm up caches and connections and load the default product and allowed prices in a background thread when Django starts.
+        """
+        return getattr(django_settings, 'STRIPE_WARM_UP_ON_STARTUP', False)
+
+    @property
+    def STRIPE_FEATURES_METADATA_KEY(self) -> str:
+        """
+        The product metadata key holding a comma-separated list of the features a subscription to the product gives access to.
+        """
+        return getattr(django_settings, 'STRIPE_FEATURES_METADATA_KEY', 'features')
+
 
 settings = Settings()
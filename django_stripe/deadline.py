@@ -0,0 +1,91 @@
+import time
+import stripe
+import stripe.error
+import stripe.http_client
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar('django_stripe_deadline', default=None)
+
+
+@contextmanager
+def stripe_deadline(seconds: Optional[float]):
+    """
+    Within this block, requests to the Stripe API must complete within the given number of seconds in total.
+    Each request times out after the remaining time and is not retried once the time is spent.
+    Nested deadlines can only shorten the time remaining. If seconds is None, there is no deadline.
+    Requires DeadlineRequestsClient to be the Stripe http client, which django_stripe sets on startup.
+    """
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_seconds() -> Optional[float]:
+    """
+    Seconds left before the current deadline, or None if there is no deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class DeadlineRequestsClient(stripe.http_client.RequestsClient):
+    """
+    The default Stripe http client, with the timeout of each request limited by the current stripe_deadline.
+    """
+    @property
+    def _timeout(self) -> float:
+        remaining = remaining_seconds()
+        if remaining is None:
+            return self._default_timeout
+        return max(min(remaining, self._default_timeout), 0.001)
+
+    @_timeout.setter
+    def _timeout(self, value: float):
+        self._default_timeout = value
+
+    @staticmethod
+    def _check_deadline():
+        remaining = remaining_seconds()
+        if remaining is not None and remaining <= 0:
+            raise stripe.error.APIConnectionError(
+                f'Request to the Stripe API not sent as the deadline was exceeded by {-remaining:.3f} seconds',
+                should_retry=False)
+
+    def request(self, method, url, headers, post_data=None):
+        self._check_deadline()
+        return super().request(method, url, headers, post_data)
+
+    def request_stream(self, method, url, headers, post_data=None):
+        self._check_deadline()
+        return super().request_stream(method, url, headers, post_data)
+
+    def _should_retry(self, response, api_connection_error, num_retries) -> bool:
+        """
+        Only retry if there is time to wait before retrying and still make the request.
+        """
+        remaining = remaining_seconds()
+        if remaining is not None and remaining < 2 * self.INITIAL_DELAY:
+            return False
+        return super()._should_retry(response, api_connection_error, num_retries)
+
+    def _sleep_time_seconds(self, num_retries, response=None) -> float:
+        sleep_seconds = super()._sleep_time_seconds(num_retries, response)
+        remaining = remaining_seconds()
+        if remaining is not None:
+            return min(sleep_seconds, remaining / 2)
+        return sleep_seconds
@@ -0,0 +1,60 @@
+from functools import wraps
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from django.shortcuts import redirect
+from . import payments
+from .conf import settings
+from typing import Callable, Optional
+
+
+def request_is_subscribed(request: HttpRequest, product_id: str = None) -> bool:
+    """
+    Check if the user making the request is subscribed to the given product.
+    The result is stored on the request so the decorator, middleware and views can all check it for the cost of one
+    lookup. Users with a valid allowed_access_until are allowed without checking the cache or the Stripe API.
+    """
+    product_id = product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
+    if not hasattr(request, '_stripe_subscribed'):
+        request._stripe_subscribed = {}
+    if product_id not in request._stripe_subscribed:
+        user = request.user
+        if not user.is_authenticated:
+            subscribed = False
+        elif payments.has_free_access(user):
+            subscribed = True
+        else:
+            subscribed = payments.is_subscribed_with_cache(user, product_id)
+        request._stripe_subscribed[product_id] = subscribed
+    return request._stripe_subscribed[product_id]
+
+
+def subscription_required_response(request: HttpRequest, product_id: str = None) -> Optional[HttpResponse]:
+    """
+    Return None if the user is subscribed to the product. Otherwise, redirect to the login page if not logged in,
+    or to settings.STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL, or return a 403 response.
+    """
+    if request_is_subscribed(request, product_id):
+        return None
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    if settings.STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL:
+        return redirect(settings.STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL)
+    return HttpResponseForbidden()
+
+
+def subscription_required(view_func: Callable = None, product_id: str = None):
+    """
+    Decorator for views that checks that the user is subscribed to the given product, or the default product.
+    Can be used as @subscription_required or @subscription_required(product_id='prod_...').
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(request, *args, **kwargs):
+            response = subscription_required_response(request, product_id)
+            if response:
+                return response
+            return f(request, *args, **kwargs)
+        return wrapper
+    if view_func:
+        return decorator(view_func)
+    return decorator
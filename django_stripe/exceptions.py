@@ -1,5 +1,8 @@
 import re
+import stripe
+import stripe.error
 from rest_framework import exceptions
+from typing import Dict, List
 
 
 def get_request_id_string(error_msg: str) -> str:
@@ -10,10 +13,20 @@ def get_request_id_string(error_msg: str) -> str:
 
 
 class StripeException(exceptions.APIException):
-    def __init__(self, detail=None, code=None):
+    def __init__(self, detail=None, code=None, request_id: str = None):
         super().__init__(detail=detail, code=code)
-        self.request_id = get_request_id_string(self.detail)
-        self.detail = self.detail.replace(self.request_id, "")
+        if request_id is None:
+            self.request_id = get_request_id_string(self.detail)
+            self.detail = self.detail.replace(self.request_id, "")
+        else:
+            self.request_id = f'Request {request_id}: ' if request_id else ''
+
+    @classmethod
+    def from_stripe_error(cls, e: stripe.error.StripeError) -> 'StripeException':
+        """
+        Convert a Stripe error without parsing the request id out of the message.
+        """
+        return cls(detail=e.user_message or str(e), request_id=e.request_id or '')
 
 
 class ConfigurationException(BaseException):
@@ -21,3 +34,15 @@ class ConfigurationException(BaseException):
         self.message = f'You must add the setting {setting_name} to settings.py'
         super().__init__(self.message)
 
+
+class PaymentMethodsDetachError(stripe.error.StripeError):
+    """
+    Raised when some payment methods could not be detached. The ones that were detached are in self.detached,
+    the errors for the ones which failed are in self.errors, keyed by payment method id.
+    """
+    def __init__(self, detached: List[stripe.PaymentMethod], errors: Dict[str, stripe.error.StripeError]):
+        self.detached = detached
+        self.errors = errors
+        message = f'Failed to detach {len(errors)} of {len(detached) + len(errors)} payment methods: ' + ', '.join(
+            f'{pm_id} ({e.user_message or e})' for pm_id, e in errors.items())
+        super().__init__(message)
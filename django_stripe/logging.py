@@ -1,6 +1,133 @@
+import logging
+import threading
+import time
+import stripe
+import stripe.error
+
+from collections import Counter
 from logging import getLogger
-import inflect
+from .conf import settings
+from typing import Any, Dict, Optional, Tuple
 
 
 logger = getLogger('django.django_stripe')
-p = inflect.engine()
+
+
+class _Plural:
+    def __init__(self, inflect: 'Inflect', text: str, count: int):
+        self.inflect, self.text, self.count = inflect, text, count
+
+    def __str__(self):
+        return self.inflect.no(self.text, self.count)
+
+
+class Inflect:
+    """
+    Wraps inflect.engine, which is only created when first used as importing inflect is slow.
+    lazy_no() is like no() but returns an object which is only converted to text when formatted, for use in log
+    messages so those which are not emitted do not import inflect.
+    """
+    def __init__(self):
+        self._engine = None
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            import inflect
+            self._engine = inflect.engine()
+        return self._engine
+
+    def no(self, text: str, count: int) -> str:
+        return self.engine.no(text, count)
+
+    def lazy_no(self, text: str, count: int) -> _Plural:
+        return _Plural(self, text, count)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.engine, name)
+
+
+p = Inflect()
+
+
+class StripeErrorLog:
+    """
+    Logs errors from the Stripe API by category, with a traceback only for unexpected errors.
+    Card declines and missing objects are expected and logged at info level.
+    Each category and error code is logged at most settings.STRIPE_ERROR_LOG_RATE_LIMIT times per interval.
+    Every error, logged or not, is counted in self.counts by category and code.
+    """
+    interval: int = 60
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._windows: Dict[Tuple[str, str], Tuple[float, int, int]] = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+            self._windows.clear()
+
+    @staticmethod
+    def classify(e: stripe.error.StripeError) -> Tuple[str, int]:
+        """
+        Return the category of the error and the level to log it at.
+        """
+        if isinstance(e, stripe.error.CardError):
+            return 'card_declined', logging.INFO
+        if isinstance(e, stripe.error.InvalidRequestError):
+            if e.code == 'resource_missing' or e.http_status == 404:
+                return 'not_found', logging.INFO
+            return 'invalid_request', logging.WARNING
+        if isinstance(e, (stripe.error.RateLimitError, stripe.error.APIConnectionError)):
+            return 'unavailable', logging.WARNING
+        return 'error', logging.ERROR
+
+    def _allow(self, key: Tuple[str, str]) -> Tuple[bool, int]:
+        """
+        Return whether to log this error and how many errors with the same key were not logged before it.
+        """
+        limit = settings.STRIPE_ERROR_LOG_RATE_LIMIT
+        if not limit:
+            return True, 0
+        now = time.monotonic()
+        start, logged, suppressed = self._windows.get(key, (now, 0, 0))
+        if now - start >= self.interval:
+            start, logged = now, 0
+        if logged < limit:
+            self._windows[key] = (start, logged + 1, 0)
+            return True, suppressed
+        self._windows[key] = (start, logged, suppressed + 1)
+        return False, 0
+
+    def log(self, e: stripe.error.StripeError, request: Any = None):
+        category, level = self.classify(e)
+        code = e.code or type(e).__name__
+        key = (category, code)
+        with self._lock:
+            self.counts[key] += 1
+            allowed, suppressed = self._allow(key)
+        if not allowed:
+            return
+        user = getattr(request, 'user', None)
+        details: Dict[str, Optional[Any]] = {
+            'category': category,
+            'code': code,
+            'decline_code': getattr(e, 'decline_code', None),
+            'http_status': e.http_status,
+            'request_id': e.request_id,
+            'user_id': user.id if user and user.is_authenticated else None,
+            'path': getattr(request, 'path', None),
+            'suppressed': suppressed
+        }
+        msg = 'Stripe %s error %s: %s'
+        args = [category, code, e.user_message or e]
+        if suppressed:
+            msg += ' (%s not logged)'
+            args.append(p.lazy_no('similar error', suppressed))
+        logger.log(level, msg, *args, exc_info=e if level >= logging.ERROR else None,
+                   extra={'stripe_error': details})
+
+
+stripe_error_log = StripeErrorLog()
@@ -0,0 +1,41 @@
+import time
+from django.core.management.base import BaseCommand
+
+from django_stripe.logging import p
+from django_stripe.models import StripeEvent
+from django_stripe.webhooks import poll_events, process_events
+
+from typing import Optional
+
+
+class Command(BaseCommand):
+    help = ("Retrieve new events from the Stripe Events API and apply them, for sites which cannot receive webhooks. "
+            "Each poll continues from the newest event retrieved by the previous one.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds to wait between polls.")
+        parser.add_argument('--once', action='store_true',
+                            help="Poll once and exit, for running from a task scheduler.")
+        parser.add_argument('--backfill-hours', type=float, default=None,
+                            help="On the first poll, apply events created in this many hours before it. "
+                                 "By default, only events created after the first poll are applied.")
+        parser.add_argument('--cursor', default='default',
+                            help="Name of the stored position in the Events API, if several pollers are needed.")
+
+    def handle(self, *args, interval: float = 30, once: bool = False, backfill_hours: Optional[float] = None,
+               cursor: str = 'default', **options):
+        backfill_seconds = backfill_hours * 3600 if backfill_hours is not None else None
+        try:
+            while True:
+                retrieved = poll_events(cursor_name=cursor, backfill_seconds=backfill_seconds)
+                results = process_events()
+                if retrieved or once:
+                    self.stdout.write(f"Retrieved {p.no('event', retrieved)}, applied {results[StripeEvent.APPLIED]}, "
+                                      f"skipped {results[StripeEvent.SKIPPED]} stale, "
+                                      f"{results[StripeEvent.FAILED]} failed.")
+                if once:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
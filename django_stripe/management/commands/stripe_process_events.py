@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from django_stripe.logging import p
+from django_stripe.models import StripeEvent
+from django_stripe.webhooks import process_events
+
+
+class Command(BaseCommand):
+    help = ("Apply Stripe events received by the webhook view which have not been applied yet, in the order they "
+            "were created on Stripe. Events older than one already applied for the same object are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Apply events which failed previously again.")
+        parser.add_argument('--release-processing', action='store_true',
+                            help="Apply events again which were claimed by a processor which did not finish, "
+                                 "for example because it was killed. Only use if no other processor is running.")
+
+    def handle(self, *args, retry_failed: bool = False, release_processing: bool = False, **options):
+        statuses = [s for s, enabled in ((StripeEvent.FAILED, retry_failed),
+                                         (StripeEvent.PROCESSING, release_processing)) if enabled]
+        if statuses:
+            StripeEvent.objects.filter(status__in=statuses).update(status=StripeEvent.PENDING)
+        results = process_events()
+        self.stdout.write(f"Applied {p.no('event', results[StripeEvent.APPLIED])}, "
+                          f"skipped {results[StripeEvent.SKIPPED]} stale, {results[StripeEvent.FAILED]} failed.")
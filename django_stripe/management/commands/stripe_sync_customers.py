@@ -0,0 +1,86 @@
+import stripe
+import stripe.error
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from django_stripe import payments
+from django_stripe.logging import logger, p
+from django_stripe.utils import get_customer_details_changes
+
+from typing import Any, Dict, Iterator, List
+
+
+class Command(BaseCommand):
+    help = ("Reconcile the email and description of every Stripe customer with the details of the linked user. "
+            "Customers are listed from Stripe page by page and only customers with real differences are modified.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report the differences without modifying any customers on Stripe.")
+        parser.add_argument('--page-size', type=int, default=100,
+                            help="Number of customers to request from Stripe per page. Maximum is 100.")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Number of customers to modify on Stripe concurrently.")
+
+    @staticmethod
+    def list_customer_pages(page_size: int) -> Iterator[List[stripe.Customer]]:
+        """
+        Yields each page of customers from the Stripe API.
+        """
+        kwargs = {'limit': page_size}
+        while True:
+            page = stripe.Customer.list(**kwargs)
+            if page['data']:
+                yield page['data']
+            if not page['has_more'] or not page['data']:
+                break
+            kwargs['starting_after'] = page['data'][-1]['id']
+
+    def get_changes(self, customers: List[stripe.Customer]) -> List[Dict[str, Any]]:
+        """
+        Join a page of customers against the users table in a single query and return the customers which differ.
+        """
+        User = get_user_model()
+        users = User.objects.filter(stripe_customer_id__in=[c['id'] for c in customers]).only(
+            'id', 'email', 'first_name', 'last_name', 'stripe_customer_id')
+        customers_by_id = {c['id']: c for c in customers}
+        changes = []
+        for user in users:
+            customer = customers_by_id[user.stripe_customer_id]
+            modify_kwargs = get_customer_details_changes(user, customer)
+            if modify_kwargs:
+                changes.append({'user': user, 'customer': customer, 'modify_kwargs': modify_kwargs})
+        return changes
+
+    def report_change(self, change: Dict[str, Any]):
+        user, customer = change['user'], change['customer']
+        for field, value in change['modify_kwargs'].items():
+            self.stdout.write(f"{customer['id']} (user {user.id}): {field} '{customer[field]}' -> '{value}'")
+
+    def handle(self, *args, dry_run: bool = False, page_size: int = 100, workers: int = 8, **options):
+        checked = matched = failed = 0
+        modified = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for customers in self.list_customer_pages(page_size):
+                checked += len(customers)
+                changes = self.get_changes(customers)
+                matched += len(changes)
+                for change in changes:
+                    self.report_change(change)
+                    if not dry_run:
+                        futures.append((change, executor.submit(
+                            payments.modify_customer, change['user'], **change['modify_kwargs'])))
+            for change, future in futures:
+                try:
+                    future.result()
+                    modified.append(change)
+                except stripe.error.StripeError as e:
+                    failed += 1
+                    logger.exception(e, exc_info=e)
+                    self.stderr.write(f"Failed to modify {change['customer']['id']}: {e}")
+        if dry_run:
+            self.stdout.write(f"Checked {p.no('customer', checked)}, {matched} would be modified.")
+        else:
+            self.stdout.write(f"Checked {p.no('customer', checked)}, modified {len(modified)}, {failed} failed.")
@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+
+from django_stripe.logging import logger, p
+from django_stripe.models import StripeOperation
+from django_stripe.operations import (claim_operation, get_ready_operations, release_stale_operations, run_operation,
+                                      send_heartbeat)
+from django_stripe.utils import _close_connections_after
+
+from typing import Dict, Optional
+
+
+class Command(BaseCommand):
+    help = ("Process queued Stripe operations. Operations for the same customer run one at a time in the order "
+            "they were queued, while operations for different customers run concurrently.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Number of operations to run concurrently.")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait between checks for new operations when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once no operations are ready to run, instead of waiting for new ones.")
+        parser.add_argument('--stale-seconds', type=float, default=600,
+                            help="Running operations whose worker has not sent a heartbeat for longer than this are "
+                                 "assumed to belong to a worker which has died and are run again. Each worker sends "
+                                 "a heartbeat for its running operations every quarter of this time.")
+        parser.add_argument('--prune-days', type=int, default=None,
+                            help="Delete completed operations older than this number of days on startup.")
+
+    def prune(self, days: int):
+        deleted, _ = StripeOperation.objects.filter(
+            status=StripeOperation.DONE, completed__lt=timezone.now() - timedelta(days=days)).delete()
+        self.stdout.write(f"Deleted {p.no('completed operation', deleted)}.")
+
+    def handle(self, *args, workers: int = 8, interval: float = 1.0, once: bool = False,
+               stale_seconds: float = 600, prune_days: Optional[int] = None, **options):
+        if prune_days is not None:
+            self.prune(prune_days)
+        succeeded = failed = 0
+        running: Dict[Future, StripeOperation] = {}
+        next_stale_check = 0.0
+        next_heartbeat = time.monotonic() + stale_seconds / 4
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    if time.monotonic() >= next_stale_check:
+                        released = release_stale_operations(stale_seconds)
+                        if released:
+                            logger.warning('Released %s', p.lazy_no('stale Stripe operation', released))
+                        next_stale_check = time.monotonic() + stale_seconds / 2
+                    if running and time.monotonic() >= next_heartbeat:
+                        send_heartbeat(running.values())
+                        next_heartbeat = time.monotonic() + stale_seconds / 4
+                    free = workers - len(running)
+                    if free:
+                        busy = {op.customer_id for op in running.values()}
+                        for op in get_ready_operations(free, exclude_customers=busy):
+                            if claim_operation(op):
+                                running[executor.submit(_close_connections_after, run_operation, op)] = op
+                    if not running:
+                        if once:
+                            break
+                        time.sleep(interval)
+                        continue
+                    done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        op = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logger.exception('Error running Stripe operation %s: %s', op, e)
+                            result = False
+                        if result:
+                            succeeded += 1
+                        else:
+                            failed += 1
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping, waiting for running operations to finish.")
+        self.stdout.write(f"Processed {p.no('operation', succeeded + failed)}, {failed} unsuccessful.")
@@ -0,0 +1,27 @@
+from django.http import HttpRequest
+from .conf import settings
+from .decorators import subscription_required_response
+from typing import Optional
+
+
+class SubscriptionRequiredMiddleware:
+    """
+    Require a subscription to access url paths beginning with the prefixes in settings.STRIPE_SUBSCRIPTION_REQUIRED_PATHS.
+    Must be placed after AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def get_product_id(self, request: HttpRequest) -> Optional[str]:
+        for prefix, product_id in settings.STRIPE_SUBSCRIPTION_REQUIRED_PATHS.items():
+            if request.path_info.startswith(prefix):
+                return product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
+        return None
+
+    def __call__(self, request: HttpRequest):
+        product_id = self.get_product_id(request)
+        if product_id:
+            response = subscription_required_response(request, product_id)
+            if response:
+                return response
+        return self.get_response(request)
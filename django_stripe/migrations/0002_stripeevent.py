@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stripe', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(db_index=True, max_length=64)),
+                ('object_id', models.CharField(db_index=True, max_length=255)),
+                ('created', models.DateTimeField()),
+                ('data', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('applied', 'Applied'), ('skipped', 'Skipped'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ('created', 'id'),
+                'indexes': [models.Index(fields=['status', 'created', 'id'], name='django_stri_status_5ab3a6_idx'), models.Index(fields=['object_id', 'status', 'created'], name='django_stri_object__c0eaa5_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stripe', '0002_stripeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEventCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('event_id', models.CharField(blank=True, max_length=255)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stripe', '0003_stripeeventcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeoperation',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
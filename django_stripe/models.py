@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 
 
@@ -7,3 +8,98 @@ class StripeCustomerUser(AbstractUser):
 
     class Meta:
         abstract = True
+
+
+class StripeSubscriptionUser(StripeCustomerUser):
+    """
+    Stores the status of the user's current subscription alongside the customer id.
+    These fields are kept updated by django_stripe whenever it creates, modifies or cancels a subscription,
+    allowing users to be filtered by subscription status in the ORM.
+    """
+    stripe_subscription_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_product_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_price_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_subscription_status = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    stripe_current_period_end = models.DateTimeField(blank=True, null=True)
+    stripe_cancel_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+
+
+class StripeOperation(models.Model):
+    """
+    A queued operation on the Stripe API for a customer, processed by the stripe_worker management command.
+    Operations for the same customer run one at a time in the order they were queued.
+    When an operation is done, its kwargs are cleared and the row is kept as an audit trail.
+    While an operation is running, the worker running it updates heartbeat regularly.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    customer_id = models.CharField(max_length=255, db_index=True)
+    operation = models.CharField(max_length=64)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    completed = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [models.Index(fields=('status', 'customer_id', 'id'))]
+
+    def __str__(self):
+        return f'{self.operation} for {self.customer_id} ({self.status})'
+
+
+class StripeEvent(models.Model):
+    """
+    An event received from a Stripe webhook. Events are stored as soon as they are received and applied later,
+    in the order they were created on Stripe, by django_stripe.webhooks.process_events.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    APPLIED = 'applied'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (PROCESSING, 'Processing'), (APPLIED, 'Applied'), (SKIPPED, 'Skipped'),
+                      (FAILED, 'Failed'))
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=64, db_index=True)
+    object_id = models.CharField(max_length=255, db_index=True)
+    created = models.DateTimeField()
+    data = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('created', 'id')
+        indexes = [models.Index(fields=('status', 'created', 'id')),
+                   models.Index(fields=('object_id', 'status', 'created'))]
+
+    def __str__(self):
+        return f'{self.type} {self.event_id} ({self.status})'
+
+
+class StripeEventCursor(models.Model):
+    """
+    The id of the newest event retrieved from the Stripe Events API by django_stripe.webhooks.poll_events,
+    so the next poll only retrieves events created after it.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    event_id = models.CharField(max_length=255, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name}: {self.event_id}'
@@ -0,0 +1,170 @@
+import stripe
+import stripe.error
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from .conf import settings
+from .logging import logger
+from .models import StripeOperation
+from . import payments
+from .utils import get_customer_details_changes
+
+from typing import Any, Callable, Dict, List, Iterable
+
+
+operations: Dict[str, Callable[..., Any]] = {}
+
+
+# Errors which will not succeed however many times the operation is retried
+permanent_errors = (stripe.error.InvalidRequestError, stripe.error.CardError, stripe.error.AuthenticationError,
+                    stripe.error.PermissionError)
+
+
+def register_operation(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Register a function which can be queued with enqueue. The function is called with the customer id and the
+    kwargs given to enqueue, which must be JSON serializable.
+    """
+    def decorator(f: Callable[..., Any]) -> Callable[..., Any]:
+        operations[name] = f
+        return f
+    return decorator
+
+
+def enqueue(operation: str, customer_id: str, **kwargs) -> StripeOperation:
+    """
+    Queue an operation for the customer. It runs after all operations queued before it for the same customer.
+    """
+    if operation not in operations:
+        raise ValueError(f'Unknown Stripe operation: {operation}')
+    logger.debug('Queueing %s for customer %s', operation, customer_id)
+    return StripeOperation.objects.create(customer_id=customer_id, operation=operation, kwargs=kwargs)
+
+
+def _get_user(customer_id: str):
+    User = get_user_model()
+    return User.objects.filter(stripe_customer_id=customer_id).first()
+
+
+@register_operation('sync_customer_details')
+def sync_customer_details(customer_id: str) -> None:
+    """
+    Update the customer's email and description from the user's details at the time the operation runs,
+    so several queued updates for the same user only modify the customer once.
+    """
+    user = _get_user(customer_id)
+    if user:
+        customer = stripe.Customer.retrieve(customer_id)
+        modify_kwargs = get_customer_details_changes(user, customer)
+        if modify_kwargs:
+            payments.modify_customer(user, **modify_kwargs)
+
+
+def enqueue_sync_customer_details(customer_id: str) -> StripeOperation:
+    """
+    Queue sync_customer_details for the customer, unless it is already the last operation queued for them and has
+    not started yet, in which case it will pick up the latest details when it runs.
+    """
+    op = StripeOperation.objects.filter(customer_id=customer_id, status=StripeOperation.PENDING).last()
+    if op and op.operation == 'sync_customer_details':
+        return op
+    return enqueue('sync_customer_details', customer_id)
+
+
+@register_operation('modify_customer')
+def modify_customer(customer_id: str, **kwargs) -> None:
+    user = _get_user(customer_id)
+    if user:
+        payments.modify_customer(user, **kwargs)
+    else:
+        stripe.Customer.modify(customer_id, **kwargs)
+
+
+@register_operation('delete_customer')
+def delete_customer(customer_id: str) -> None:
+    stripe.Customer.delete(customer_id)
+
+
+def get_ready_operations(limit: int, exclude_customers: Iterable[str] = ()) -> List[StripeOperation]:
+    """
+    Returns up to limit operations which are due to run. Only the oldest unfinished operation of each customer
+    is returned, so nothing is returned for a customer while one of their operations is running or waiting to retry.
+    """
+    heads = StripeOperation.objects.filter(
+        status__in=(StripeOperation.PENDING, StripeOperation.RUNNING)).order_by().values(
+        'customer_id').annotate(head=Min('id')).values('head')
+    return list(StripeOperation.objects.filter(
+        id__in=heads, status=StripeOperation.PENDING, run_after__lte=timezone.now()).exclude(
+        customer_id__in=list(exclude_customers))[:limit])
+
+
+def claim_operation(op: StripeOperation) -> bool:
+    """
+    Mark a pending operation as running. Returns False if another worker claimed it first.
+    """
+    now = timezone.now()
+    claimed = StripeOperation.objects.filter(id=op.id, status=StripeOperation.PENDING).update(
+        status=StripeOperation.RUNNING, started=now, heartbeat=now, attempts=F('attempts') + 1)
+    if claimed:
+        op.status, op.started, op.heartbeat, op.attempts = StripeOperation.RUNNING, now, now, op.attempts + 1
+    return bool(claimed)
+
+
+def send_heartbeat(ops: Iterable[StripeOperation]) -> int:
+    """
+    Record that the worker running the given operations is still alive, so they are not released as stale.
+    """
+    return StripeOperation.objects.filter(id__in=[op.id for op in ops], status=StripeOperation.RUNNING).update(
+        heartbeat=timezone.now())
+
+
+def get_retry_delay(attempts: int) -> timedelta:
+    seconds = settings.STRIPE_OPERATION_RETRY_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.STRIPE_OPERATION_MAX_RETRY_SECONDS))
+
+
+def run_operation(op: StripeOperation) -> bool:
+    """
+    Run a claimed operation and record the result.
+    Failures are retried with exponential backoff until settings.STRIPE_OPERATION_MAX_ATTEMPTS is reached,
+    apart from errors which retrying cannot fix, which fail the operation straight away.
+    Returns True if the operation succeeded.
+    """
+    try:
+        f = operations[op.operation]
+    except KeyError:
+        return _fail_operation(op, f'Unknown Stripe operation: {op.operation}', permanent=True)
+    try:
+        f(op.customer_id, **op.kwargs)
+    except Exception as e:
+        logger.exception('Stripe operation %s failed: %s', op, e)
+        return _fail_operation(op, str(e), permanent=isinstance(e, permanent_errors))
+    StripeOperation.objects.filter(id=op.id).update(
+        status=StripeOperation.DONE, completed=timezone.now(), kwargs={}, last_error='')
+    return True
+
+
+def _fail_operation(op: StripeOperation, error: str, permanent: bool) -> bool:
+    now = timezone.now()
+    if permanent or op.attempts >= settings.STRIPE_OPERATION_MAX_ATTEMPTS:
+        StripeOperation.objects.filter(id=op.id).update(
+            status=StripeOperation.FAILED, completed=now, last_error=error)
+    else:
+        StripeOperation.objects.filter(id=op.id).update(
+            status=StripeOperation.PENDING, run_after=now + get_retry_delay(op.attempts), last_error=error)
+    return False
+
+
+def release_stale_operations(seconds: float) -> int:
+    """
+    Return running operations whose worker has not sent a heartbeat for longer than the given number of seconds to
+    the queue, for example after a worker was killed part way through an operation. Operations which are only slow
+    are not released, as their worker keeps sending heartbeats. A released operation runs again from the start, so
+    operations should be safe to repeat.
+    """
+    cutoff = timezone.now() - timedelta(seconds=seconds)
+    return StripeOperation.objects.filter(
+        Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True, started__lt=cutoff),
+        status=StripeOperation.RUNNING).update(status=StripeOperation.PENDING)
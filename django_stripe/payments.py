@@ -1,25 +1,35 @@
+import contextvars
+import datetime
 import stripe
 import stripe.error
 import subscriptions
 
 # Next line is so these functions can be used by django_stripe user without needing to import from subscriptions
-from subscriptions import cancel_subscription, cancel_subscription_for_product, delete_customer
+from subscriptions import delete_customer
 
-from subscriptions.types import PaymentMethodType
+from subscriptions.types import PaymentMethodType, SubscriptionInfo
 from functools import wraps
 from django.core.cache import caches, cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core import exceptions
+from django.contrib.auth import get_user_model
 from django import http
+from django.db import transaction
 from django.utils import timezone
 from rest_framework.exceptions import NotAuthenticated, PermissionDenied, NotFound
 
 from .conf import settings
 from .logging import logger, p
 from . import signals
-
-from .utils import get_actual_user, user_description
-from typing import List, Dict, Any, Callable, Generator, Optional, Type
-from .types import DjangoUserProtocol, SubscriptionInfoWithEvaluation
+from . import catalog
+from .catalog import price_index
+from .cache import TieredCache
+from .deadline import stripe_deadline  # noqa: F401 (re-exported for use as django_stripe.payments.stripe_deadline)
+from .exceptions import PaymentMethodsDetachError
+from .utils import get_actual_user, user_description, executor, run_in_background
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Generator, Iterable, Mapping, Optional, Type
+from .types import DjangoUserProtocol, Entitlements, ProductEntitlement, SubscriptionInfoWithEvaluation
 
 
 FREE = "FREE"
@@ -28,6 +38,14 @@ FREE = "FREE"
 subscription_alive_statuses = ["active", "incomplete", "trialing", "past_due", "unpaid"]
 
 
+# Subscription statuses which give access to a product's features, matching is_subscribed
+entitled_statuses = ["active"]
+
+
+subscription_status_fields = ('stripe_subscription_id', 'stripe_product_id', 'stripe_price_id',
+                              'stripe_subscription_status', 'stripe_current_period_end', 'stripe_cancel_at')
+
+
 def add_stripe_customer_if_not_existing(f):
     """
     Decorator which creates user as a customer if not already existing before making a request to the Stripe API
@@ -71,15 +89,38 @@ def create_customer(user: DjangoUserProtocol, **kwargs):
     if not user or not user.is_authenticated:
         raise NotAuthenticated('This stripe method requires a logged in user')
     if not user.stripe_customer_id:
-        logger.debug('Creating user %s on stripe', user.id)
-        customer_kwargs = settings.STRIPE_NEW_CUSTOMER_GET_KWARGS(user, **kwargs)
-        customer = subscriptions.create_customer(user, description=user_description(user), **customer_kwargs)
-        user.save(update_fields=('stripe_customer_id',))
+        with transaction.atomic():
+            # Lock the user row so a customer being created at the same time, for example in the background after
+            # signup, is not created twice
+            stripe_customer_id = type(user).objects.select_for_update().filter(pk=user.pk).values_list(
+                'stripe_customer_id', flat=True).first()
+            if stripe_customer_id:
+                user.stripe_customer_id = stripe_customer_id
+                return user
+            logger.debug('Creating user %s on stripe', user.id)
+            customer_kwargs = settings.STRIPE_NEW_CUSTOMER_GET_KWARGS(user, **kwargs)
+            customer = subscriptions.create_customer(user, description=user_description(user), **customer_kwargs)
+            user.save(update_fields=('stripe_customer_id',))
         signals.new_customer.send(sender=user, customer=customer)
         logger.debug('Stripe: Created user %s on stripe. Customer id is %s', user.id, user.stripe_customer_id)
     return user
 
 
+def create_customer_for_user_id(user_id: Any) -> Optional[DjangoUserProtocol]:
+    """
+    Load the user with the given id and create them as a customer if not already existing.
+    Used for creating customers in the background, so any errors are logged rather than raised.
+    """
+    try:
+        user = get_user_model().objects.get(id=user_id)
+        if not user.stripe_customer_id:
+            return create_customer(user)
+        return user
+    except Exception as e:
+        logger.exception('Failed to create customer for user %s in the background', user_id, exc_info=e)
+        return None
+
+
 @get_actual_user
 @subscriptions.decorators.customer_id_required
 def modify_customer(user: DjangoUserProtocol, **kwargs) -> stripe.Customer:
@@ -135,6 +176,24 @@ def create_checkout(user: DjangoUserProtocol, method: Callable, **kwargs) -> str
     return session
 
 
+def check_price_allowed(user: DjangoUserProtocol, price_id: str, rest: bool = False):
+    """
+    Check that the price exists and, if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY is True, that it belongs to the default product.
+    Uses the in-memory price index unless settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS is None, in which case the price is retrieved from Stripe.
+    """
+    if settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS is None:
+        try:
+            retrieve_price(user, price_id, rest=rest)
+        except stripe.error.InvalidRequestError:
+            raise_appropriate_not_found(rest, f"No such price: '{price_id}'")
+        return
+    product_id = price_index.get_product(price_id)
+    if not product_id:
+        raise_appropriate_not_found(rest, f"No such price: '{price_id}'")
+    if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY and not product_id == settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID:
+        raise_appropriate_permission_denied(rest, f"Cannot access price {price_id}")
+
+
 def create_subscription_checkout(user: DjangoUserProtocol, price_id: str, rest: bool = False,
                                  **kwargs) -> stripe.checkout.Session:
     """
@@ -142,10 +201,7 @@ def create_subscription_checkout(user: DjangoUserProtocol, price_id: str, rest:
     An exception will be raised if the price does not exist. If rest is True, this will be a Rest Framework exception.
     A checkout_created signal is sent.
     """
-    try:
-        retrieve_price(user, price_id, rest=rest)            # To check that price is allowed depending on settings
-    except stripe.error.InvalidRequestError:
-        raise raise_appropriate_not_found(rest, f"No such price: '{price_id}'")
+    check_price_allowed(user, price_id, rest=rest)
     logger.debug('Creating new subscription checkout session for user %s', user.id)
     return create_checkout(user, subscriptions.create_subscription_checkout, price_id=price_id, **kwargs)
 
@@ -176,21 +232,81 @@ def create_billing_portal(user) -> stripe.billing_portal.Session:
     return session
 
 
+def get_subscribed_prices(user: Optional[DjangoUserProtocol]) -> Dict[str, SubscriptionInfo]:
+    """
+    Return the subscription info for each price the user has an active subscription to, keyed by price_id.
+    No request is made to the Stripe API for anonymous users or users without a customer id.
+    """
+    if not user or not user.stripe_customer_id:
+        return {}
+    return {s['price_id']: {'sub_id': s['sub_id'], 'cancel_at': s['cancel_at'],
+                            'current_period_end': s['current_period_end']}
+            for s in subscriptions.list_products_prices_subscribed_to(user)}
+
+
+def _get_subscribed_prices_future(user: Optional[DjangoUserProtocol], product_id: Optional[str] = None) -> Future:
+    """
+    Start getting the user's subscribed prices while the catalog is loaded.
+    If product_id is given, only the price subscribed to for that product is returned, from the subscription cache.
+    The thread runs in a copy of the current context, so it has the same stripe_deadline.
+    """
+    if not user or not user.stripe_customer_id:
+        future = Future()
+        future.set_result({})
+        return future
+    if product_id:
+        return executor.submit(contextvars.copy_context().run, get_subscribed_prices_with_cache, user, product_id)
+    return executor.submit(contextvars.copy_context().run, get_subscribed_prices, user)
+
+
+def _empty_subscription_info() -> SubscriptionInfo:
+    return {'sub_id': None, 'current_period_end': None, 'cancel_at': None}
+
+
+def add_subscription_info_to_prices(prices: List[Dict[str, Any]],
+                                    subscribed_prices: Dict[str, SubscriptionInfo]) -> List[Dict[str, Any]]:
+    """
+    Overlay the user's subscription info onto prices from the shared catalog.
+    """
+    for price in prices:
+        price['subscription_info'] = subscribed_prices.get(price['id']) or _empty_subscription_info()
+    return prices
+
+
+def add_subscription_info_to_product(product: Dict[str, Any],
+                                     subscribed_prices: Dict[str, SubscriptionInfo]) -> Dict[str, Any]:
+    """
+    Overlay the user's subscription info onto a product and its prices from the shared catalog.
+    """
+    product['subscription_info'] = _empty_subscription_info()
+    for price in add_subscription_info_to_prices(product['prices'], subscribed_prices):
+        if price['subscription_info']['sub_id']:
+            product['subscription_info'] = price['subscription_info']
+    return product
+
+
 @get_actual_user
 def get_products(user, ids: List[str] = None, price_kwargs: Dict[str, Any] = None, rest: bool = False,
-                 **kwargs) -> List[Dict[str, Any]]:
+                 only_with_prices: bool = False, **kwargs) -> List[Dict[str, Any]]:
     """
     Get a list of products.
     Ids a is list of product_ids to filter on.
     If settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY is True and ids contains another product, then permission denied exception is raised.
     If rest is True, this is a Rest Framework Exception.
+    Unless kwargs filters are given for stripe.Product.list, products are loaded with one paginated request listing
+    active prices and one listing active products. If only_with_prices is True, products without any active prices
+    are not included, so only the request listing prices is needed.
+    Products and prices come from the shared catalog cache, only the subscription info is requested for each user.
     """
     if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY:
         for product in ids or []:
             if not product == settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID:
                 raise_appropriate_permission_denied(rest, f"Cannot access product {product}")
         ids = [settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID]
-    return subscriptions.get_subscription_products_and_prices(user, ids=ids, price_kwargs=price_kwargs, **kwargs)
+    subscribed_prices = _get_subscribed_prices_future(user)
+    products = catalog.get_products(ids=ids, price_kwargs=price_kwargs, only_with_prices=only_with_prices, **kwargs)
+    subscribed_prices = subscribed_prices.result()
+    return [add_subscription_info_to_product(product, subscribed_prices) for product in products]
 
 
 @get_actual_user
@@ -200,13 +316,15 @@ def get_prices(user, product: str = None, currency: str = None, rest: bool = Fal
     Ids a is list of product_ids to filter on.
     Currency allows to filter on currency.
     If settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY is True, and product is another id, an exception is raised. If rest is True, this is a Rest Framework Exception.
+    Prices come from the shared catalog cache, only the subscription info is requested for each user.
     """
     if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY:
         if product and not product == settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID:
             raise_appropriate_permission_denied(rest, f"Cannot access product {product}")
         product = settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
-    result = subscriptions.get_subscription_prices(user, product=product, currency=currency, **kwargs)
-    return result
+    subscribed_prices = _get_subscribed_prices_future(user)
+    prices = catalog.get_prices(product=product, currency=currency, **kwargs)
+    return add_subscription_info_to_prices(prices, subscribed_prices.result())
 
 
 @get_actual_user
@@ -215,10 +333,13 @@ def retrieve_product(user, obj_id: str, price_kwargs: Optional[Dict[str, Any]] =
     """
     Retrieve a single product with prices and subscription information included in the result.
     price_kwargs is a list of filters provided to stripe.Price.list
+    The subscription information comes from the same cache entry as is_subscribed_with_cache.
     """
     if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY and not obj_id == settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID:
         raise_appropriate_permission_denied(rest, f"Cannot access product {obj_id}")
-    return subscriptions.retrieve_product(user, obj_id, price_kwargs=price_kwargs)
+    subscribed_prices = _get_subscribed_prices_future(user, obj_id)
+    product = catalog.retrieve_product(obj_id, price_kwargs=price_kwargs)
+    return add_subscription_info_to_product(product, subscribed_prices.result())
 
 
 @get_actual_user
@@ -226,10 +347,11 @@ def retrieve_price(user, obj_id: str, rest: bool = False) -> Dict[str, Any]:
     """
     Retrieve a single price with subscription info
     """
-    price = subscriptions.retrieve_price(user, obj_id)
+    subscribed_prices = _get_subscribed_prices_future(user)
+    price = catalog.retrieve_price(obj_id)
     if settings.STRIPE_ALLOW_DEFAULT_PRODUCT_ONLY and not price['product'] == settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID:
         raise_appropriate_permission_denied(rest, f"Cannot access price {obj_id}")
-    return price
+    return add_subscription_info_to_prices([price], subscribed_prices.result())[0]
 
 
 @get_actual_user
@@ -286,16 +408,32 @@ def detach_payment_method(user, pm_id: str) -> stripe.PaymentMethod:
 def detach_all_payment_methods(user, types: List[PaymentMethodType] = None, **kwargs) -> List[stripe.PaymentMethod]:
     """
     Detach all of a user's payment methods of the given types.
-    The payment_method_detached signal is sent.
+    Up to settings.STRIPE_DETACH_PAYMENT_METHODS_MAX_WORKERS payment methods are detached in parallel.
+    The payment_method_detached signal is sent once with all the payment methods which were detached.
+    If any payment methods could not be detached, PaymentMethodsDetachError is raised after the signal is sent.
     """
     types = types or settings.STRIPE_PAYMENT_METHOD_TYPES
     logger.debug('Detaching all payment method for user %s with types: %s', user.id, types)
-    payment_methods = subscriptions.detach_all_payment_methods(user, types, **kwargs)
+    pm_ids = [pm['id'] for pm in subscriptions.list_payment_methods(user, types, **kwargs)]
+    if not pm_ids:
+        logger.info('No payment methods for user %s found with types %s', user.id, types)
+        return []
+    payment_methods = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(len(pm_ids), settings.STRIPE_DETACH_PAYMENT_METHODS_MAX_WORKERS),
+                            thread_name_prefix='django_stripe_detach') as pool:
+        futures = {pm_id: pool.submit(stripe.PaymentMethod.detach, pm_id) for pm_id in pm_ids}
+    for pm_id, future in futures.items():
+        try:
+            payment_methods.append(future.result())
+        except stripe.error.StripeError as e:
+            logger.warning('Failed to detach payment method %s for user %s: %s', pm_id, user.id, e)
+            errors[pm_id] = e
     if payment_methods:
         signals.payment_method_detached.send(sender=user, payment_methods=payment_methods)
-        logger.debug('Detached %s for user %s', p.no('payment method', len(payment_methods)), user.id)
-    else:
-        logger.info('No payment methods for user %s found with types %s')
+        logger.debug('Detached %s for user %s', p.lazy_no('payment method', len(payment_methods)), user.id)
+    if errors:
+        raise PaymentMethodsDetachError(payment_methods, errors)
     return payment_methods
 
 
@@ -351,13 +489,25 @@ def list_customer_resource(user: DjangoUserProtocol, obj_cls: Type, **kwargs) ->
 
 
 @get_actual_user
-def retrieve(user: DjangoUserProtocol, obj_cls: Type, obj_id: str):
+def retrieve(user: DjangoUserProtocol, obj_cls: Type, obj_id: str, **kwargs):
     """
     Retrieve an object over Stripe API for the given obj_id and obj_cls.
     obj_cls could be stripe.Subscription, stripe.PaymentMethod, stripe.Invoice, etc.
+    kwargs such as expand are passed to obj_cls.retrieve.
     If a customer attempts to retrieve an object belonging to another customer, StripeWrongCustomer exception is raised.
     """
-    return subscriptions.retrieve(user, obj_cls, obj_id)
+    if not kwargs:
+        return subscriptions.retrieve(user, obj_cls, obj_id)
+    return _retrieve_if_owned(user, obj_cls, obj_id, **kwargs)
+
+
+@subscriptions.decorators.customer_id_required
+def _retrieve_if_owned(user: DjangoUserProtocol, obj_cls: Type, obj_id: str, **kwargs):
+    obj = obj_cls.retrieve(obj_id, **kwargs)
+    if obj['customer'] != user.stripe_customer_id:
+        raise subscriptions.exceptions.StripeWrongCustomer(
+            f"Customer {user.stripe_customer_id} cannot retrieve {obj['object']} {obj_id} as they do not own it.")
+    return obj
 
 
 @get_actual_user
@@ -377,6 +527,32 @@ def delete(user, obj_cls: Type, obj_id: str) -> Dict[str, Any]:
     return obj
 
 
+def cancel_subscription(user, subscription_id: str) -> stripe.Subscription:
+    """
+    Allow a user to cancel their subscription by subscription_id.
+    If a user attempts to cancel a subscription belonging to another customer, StripeWrongCustomer will be raised.
+    The signal subscription_cancelled is sent.
+    """
+    return delete(user, stripe.Subscription, subscription_id)
+
+
+@get_actual_user
+def cancel_subscription_for_product(user, product_id: str) -> bool:
+    """
+    Allow a user to cancel their subscription by the id of the product they are subscribed to, if such a subscription exists.
+    Returns True if the subscription exists for that user, otherwise False.
+    The signal subscription_cancelled is sent for each cancelled subscription.
+    """
+    sub_cancelled = False
+    for sub in subscriptions.list_subscriptions(user):
+        if sub.get('plan', {}).get('product') == product_id:
+            logger.debug('Cancelling subscription %s for user %s', sub['id'], user.id)
+            subscription = stripe.Subscription.delete(sub['id'])
+            signals.subscription_cancelled.send(sender=user, subscription=subscription)
+            sub_cancelled = True
+    return sub_cancelled
+
+
 @get_actual_user
 @subscriptions.decorators.customer_id_required
 def modify(user: DjangoUserProtocol, obj_cls: Type, obj_id: str, **kwargs: Dict[str, Any]):
@@ -394,19 +570,104 @@ def modify(user: DjangoUserProtocol, obj_cls: Type, obj_id: str, **kwargs: Dict[
     return obj
 
 
+def _to_datetime(timestamp: Optional[int]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc) if timestamp else None
+
+
+def _to_timestamp(value: Optional[datetime.datetime]) -> Optional[int]:
+    return int(value.timestamp()) if value else None
+
+
+def has_subscription_status_fields(user) -> bool:
+    """
+    Check if the user model stores subscription status, as in django_stripe.models.StripeSubscriptionUser.
+    """
+    return bool(user) and hasattr(user, 'stripe_subscription_status')
+
+
+def _save_subscription_status(user, sub_id: Optional[str], product_id: Optional[str], price_id: Optional[str],
+                              status: Optional[str], current_period_end: Optional[int],
+                              cancel_at: Optional[int]):
+    values = dict(zip(subscription_status_fields, (sub_id, product_id, price_id, status,
+                                                   _to_datetime(current_period_end), _to_datetime(cancel_at))))
+    changed = [field for field, value in values.items() if getattr(user, field) != value]
+    if changed:
+        for field in changed:
+            setattr(user, field, values[field])
+        user.save(update_fields=changed)
+
+
+def update_user_subscription_status(user, subscription: Mapping[str, Any]) -> bool:
+    """
+    Store the subscription's product, price, status, current_period_end and cancel_at on the user, if the user model has the fields.
+    A different subscription which is already stored and active is not replaced by one which is not active,
+    so cancelling an old subscription does not hide the current one.
+    Returns True if the user was updated.
+    """
+    if not has_subscription_status_fields(user):
+        return False
+    if (user.stripe_subscription_id and user.stripe_subscription_id != subscription['id'] and
+            user.stripe_subscription_status == 'active' and subscription['status'] != 'active'):
+        return False
+    logger.debug('Updating subscription status for user %s from subscription %s', user.id, subscription['id'])
+    _save_subscription_status(user, subscription['id'], subscription.get('plan', {}).get('product'),
+                              subscription.get('plan', {}).get('id'), subscription['status'],
+                              subscription.get('current_period_end'), subscription.get('cancel_at'))
+    return True
+
+
+def get_subscription_info_from_user(user, product_id: str) -> Optional[SubscriptionInfoWithEvaluation]:
+    """
+    Return the subscription info stored on the user if it shows an active subscription to the product which has not yet
+    reached current_period_end or cancel_at. Otherwise None is returned, as the subscription may have been renewed or
+    created outside of django_stripe, so Stripe must be checked.
+    """
+    if not has_subscription_status_fields(user) or not (
+            user.stripe_subscription_status == 'active' and user.stripe_product_id == product_id):
+        return None
+    now = timezone.now()
+    if not user.stripe_current_period_end or user.stripe_current_period_end <= now or (
+            user.stripe_cancel_at and user.stripe_cancel_at <= now):
+        return None
+    return {'sub_id': user.stripe_subscription_id, 'cancel_at': _to_timestamp(user.stripe_cancel_at),
+            'current_period_end': _to_timestamp(user.stripe_current_period_end), 'evaluation': False,
+            'product_id': product_id, 'price_id': user.stripe_price_id}
+
+
+def has_free_access(user) -> bool:
+    """
+    Return True if the user object has attribute allowed_access_until and it is set and valid.
+    """
+    allowed_access_until = getattr(user, 'allowed_access_until', None)
+    return bool(allowed_access_until and allowed_access_until >= timezone.now())
+
+
 @get_actual_user
 def is_subscribed_and_cancelled_time(user, product_id: str = None) -> SubscriptionInfoWithEvaluation:
     """
     Return first active subscription for a specific product to quickly check if a user is subscribed.
     If the user object has attribute allowed_access_until, will check if set and valid.
+    If settings.STRIPE_USE_USER_SUBSCRIPTION_STATUS is True and the user model stores subscription status,
+    an active subscription stored on the user is returned without a request to the Stripe API. A subscription found
+    on Stripe is stored on the user if no subscription is stored yet or the stored one is for the same product.
     """
     product_id = product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
-    if hasattr(user, 'allowed_access_until') and (
-            user.allowed_access_until and user.allowed_access_until >= timezone.now()):
+    if has_free_access(user):
         return {'sub_id': FREE, 'cancel_at': None, 'current_period_end': int(user.allowed_access_until.timestamp()),
                 'evaluation': True, 'product_id': product_id, 'price_id': settings.STRIPE_FREE_ACCESS_PRICE_ID}
+    use_user_status = settings.STRIPE_USE_USER_SUBSCRIPTION_STATUS and has_subscription_status_fields(user)
+    if use_user_status:
+        sub_info = get_subscription_info_from_user(user, product_id)
+        if sub_info:
+            return sub_info
     sub_info: SubscriptionInfoWithEvaluation = subscriptions.is_subscribed_and_cancelled_time(user, product_id)
     sub_info['evaluation'] = False
+    # The user stores one subscription, so it is only replaced here if it is for the same product, otherwise
+    # checking subscriptions to different products in turn would write the user on every check
+    if use_user_status and sub_info['sub_id'] and (
+            not user.stripe_subscription_id or user.stripe_product_id == sub_info['product_id']):
+        _save_subscription_status(user, sub_info['sub_id'], sub_info['product_id'], sub_info['price_id'], 'active',
+                                  sub_info['current_period_end'], sub_info['cancel_at'])
     return sub_info
 
 
@@ -419,6 +680,51 @@ def is_subscribed(user, product_id: str = None) -> bool:
     return bool(is_subscribed_and_cancelled_time(user, product_id)['sub_id'])
 
 
+def get_product_features(product: Mapping[str, Any]) -> List[str]:
+    """
+    Return the features listed in the product's metadata under settings.STRIPE_FEATURES_METADATA_KEY.
+    """
+    value = (product.get('metadata') or {}).get(settings.STRIPE_FEATURES_METADATA_KEY) or ''
+    return [feature.strip() for feature in value.split(',') if feature.strip()]
+
+
+@get_actual_user
+def get_entitlements(user) -> Entitlements:
+    """
+    Return the products the user is subscribed to with the status, current_period_end and cancel_at of each
+    subscription and the features from the product metadata, together with the features of all products with an
+    active subscription. All the customer's subscriptions are listed in a single request with their products
+    expanded, so any number of products and features can be checked at once.
+    If the user object has attribute allowed_access_until and it is set and valid, the default product is included.
+    An empty dict is returned if there is no logged in user.
+    """
+    if not user:
+        return {}
+    products: Dict[str, ProductEntitlement] = {}
+    if has_free_access(user):
+        product_id = settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
+        products[product_id] = {
+            'sub_id': FREE, 'price_id': settings.STRIPE_FREE_ACCESS_PRICE_ID, 'status': 'active',
+            'current_period_end': int(user.allowed_access_until.timestamp()), 'cancel_at': None,
+            'features': get_product_features(catalog.retrieve_product(product_id))}
+    if user.stripe_customer_id:
+        for sub in stripe.Subscription.list(customer=user.stripe_customer_id, limit=100,
+                                            expand=['data.plan.product']).auto_paging_iter():
+            product = (sub.get('plan') or {}).get('product')
+            if not product:
+                continue
+            existing = products.get(product['id'])
+            if existing and existing['status'] in entitled_statuses:
+                continue
+            products[product['id']] = {
+                'sub_id': sub['id'], 'price_id': sub['plan']['id'], 'status': sub['status'],
+                'current_period_end': sub.get('current_period_end'), 'cancel_at': sub.get('cancel_at'),
+                'features': get_product_features(product)}
+    features = sorted({feature for entitlement in products.values() if entitlement['status'] in entitled_statuses
+                       for feature in entitlement['features']})
+    return {'products': products, 'features': features}
+
+
 def _get_subscription_cache() -> cache:
     """
     Return the cache to use to store subscription data. Default value is 'default'.
@@ -426,22 +732,195 @@ def _get_subscription_cache() -> cache:
     return caches[settings.STRIPE_SUBSCRIPTION_CACHE_NAME]
 
 
+subscription_cache = TieredCache(_get_subscription_cache, 'django_stripe_subscription_generation')
+
+
+def subscription_info_cache_key(user, product_id: str) -> str:
+    return f'subscription_info_{user.id}_{product_id}'
+
+
+def entitlements_cache_key(user) -> str:
+    return f'entitlements_{user.id}'
+
+
+def get_subscription_cache_timeout(sub_infos: Iterable[Mapping[str, Any]], max_timeout: Any = DEFAULT_TIMEOUT,
+                                   stale_seconds: float = 0) -> Optional[float]:
+    """
+    Return how long to store subscription info in the Stripe Subscription Cache: until the earliest cancel_at, or
+    current_period_end plus settings.STRIPE_SUBSCRIPTION_CACHE_GRACE_SECONDS, of the given subscriptions, but no
+    longer than max_timeout, which defaults to settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS, plus
+    stale_seconds. Returns 0 if the info should not be cached.
+    """
+    timeout = settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS if max_timeout is DEFAULT_TIMEOUT else max_timeout
+    if timeout is DEFAULT_TIMEOUT:
+        timeout = subscription_cache.get_shared_cache().default_timeout
+    if timeout:
+        timeout += stale_seconds
+    ends = []
+    for sub_info in sub_infos:
+        if sub_info.get('cancel_at'):
+            ends.append(sub_info['cancel_at'])
+        if sub_info.get('current_period_end'):
+            ends.append(sub_info['current_period_end'] + settings.STRIPE_SUBSCRIPTION_CACHE_GRACE_SECONDS)
+    if ends:
+        remaining = min(ends) - timezone.now().timestamp()
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return None if timeout is None else max(int(timeout), 0)
+
+
+def update_subscription_cache(user, subscription: Mapping[str, Any]) -> None:
+    """
+    Write a created, modified or cancelled subscription to the Stripe Subscription Cache so is_subscribed_with_cache
+    sees the change straight away. An active subscription is stored as the subscription info for its product until
+    it ends. Otherwise the cached info for the product is removed, as the user may have another subscription to it.
+    Cached entitlements are removed.
+    """
+    product = (subscription.get('plan') or {}).get('product')
+    product_id = product['id'] if isinstance(product, Mapping) else product
+    if product_id:
+        cache_key = subscription_info_cache_key(user, product_id)
+        sub_info: SubscriptionInfoWithEvaluation = {
+            'sub_id': subscription['id'], 'cancel_at': subscription.get('cancel_at'),
+            'current_period_end': subscription.get('current_period_end'), 'evaluation': False,
+            'product_id': product_id, 'price_id': subscription['plan'].get('id')}
+        if not (subscription['status'] == 'active' and _set_subscription_info(user, cache_key, sub_info)):
+            subscription_cache.delete(cache_key)
+    subscription_cache.delete(entitlements_cache_key(user))
+
+
+def _set_subscription_info(user, cache_key: str, sub_info: SubscriptionInfoWithEvaluation,
+                           notify: bool = True) -> bool:
+    """
+    Store subscription info in the Stripe Subscription Cache for the period given by get_subscription_cache_timeout,
+    or settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS if the user is not subscribed, extended by
+    settings.STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS. If refreshing ahead or stale entries are enabled, the time
+    after which the entry should be refreshed is stored with it as refresh_at. Returns False if it was not stored.
+    notify is passed to subscription_cache.set.
+    """
+    max_timeout = DEFAULT_TIMEOUT if sub_info['sub_id'] else settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS
+    if not max_timeout:
+        return False
+    stale_seconds = settings.STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS
+    timeout = get_subscription_cache_timeout([sub_info], max_timeout, stale_seconds)
+    if timeout == 0:
+        return False
+    fresh_timeout = get_subscription_cache_timeout([sub_info], max_timeout)
+    if fresh_timeout is not None and (stale_seconds or settings.STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS):
+        # Not before half way, so entries close to cancel_at are not refreshed on every check
+        refresh_in = max(fresh_timeout - settings.STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS, fresh_timeout / 2)
+        sub_info = {**sub_info, 'refresh_at': timezone.now().timestamp() + refresh_in}
+    logger.debug('Setting cache key %s for user %s subscription: %s', cache_key, user.id, sub_info['sub_id'])
+    subscription_cache.set(cache_key, sub_info, timeout=timeout, notify=notify)
+    return True
+
+
+# How long a background refresh of a subscription cache entry blocks others, in case it does not complete
+refresh_lock_seconds = 60
+
+
+def _refresh_lock_key(cache_key: str) -> str:
+    return f'{cache_key}_refreshing'
+
+
+def _refresh_subscription_info(user, product_id: str, cache_key: str) -> None:
+    try:
+        current = subscription_cache.get_shared_cache().get(cache_key)
+        if current and current.get('refresh_at', 0) > timezone.now().timestamp():
+            # Already refreshed by another process, drop the old copy from this process's local cache
+            subscription_cache.local.delete(cache_key)
+            return
+        logger.debug('Refreshing subscription data with cache key %s for user %s for product %s', cache_key, user.id,
+                     product_id)
+        sub_info = is_subscribed_and_cancelled_time(user, product_id)
+        if not _set_subscription_info(user, cache_key, sub_info):
+            subscription_cache.delete(cache_key)
+    except Exception as e:
+        logger.exception('Failed to refresh subscription data with cache key %s: %s', cache_key, e)
+    finally:
+        subscription_cache.get_shared_cache().delete(_refresh_lock_key(cache_key))
+
+
+def _refresh_subscription_info_in_background(user, product_id: str, cache_key: str) -> None:
+    """
+    Refresh the cached subscription info in the django_stripe thread pool, unless it is already being refreshed.
+    The lock is held in the shared cache so only one refresh runs across all processes.
+    """
+    if subscription_cache.get_shared_cache().add(_refresh_lock_key(cache_key), True, timeout=refresh_lock_seconds):
+        run_in_background(contextvars.copy_context().run, _refresh_subscription_info, user, product_id, cache_key)
+
+
+def is_subscribed_and_cancelled_time_with_cache(user, product_id: str = None) -> SubscriptionInfoWithEvaluation:
+    """
+    Return is_subscribed_and_cancelled_time for the user and product, stored in the Stripe Subscription Cache for the
+    period of time given by get_subscription_cache_timeout.
+    If settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE is set, values are also kept in memory in each process.
+    If settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS is set, users who are not subscribed are also cached
+    for that period.
+    If settings.STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS or settings.STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS is
+    set, entries which are about to expire or have just expired are returned straight away and refreshed in the
+    background.
+    """
+    product_id = product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
+    cache_key = subscription_info_cache_key(user, product_id)
+    sub_info = subscription_cache.get(cache_key)
+    if sub_info is None:
+        logger.debug('Retrieving subscription data with cache key %s for user %s for product %s', cache_key, user.id,
+                     product_id)
+        sub_info = is_subscribed_and_cancelled_time(user, product_id)
+        _set_subscription_info(user, cache_key, sub_info, notify=False)
+    elif sub_info.get('refresh_at') and sub_info['refresh_at'] <= timezone.now().timestamp():
+        _refresh_subscription_info_in_background(user, product_id, cache_key)
+    sub_info = dict(sub_info)
+    sub_info.pop('refresh_at', None)
+    return sub_info
+
+
 def is_subscribed_with_cache(user, product_id: str = None) -> bool:
     """
     Return first active subscription for a specific product to quickly check if a user is subscribed.
     If the user object has attribute allowed_access_until, will check if set and valid.
-    Stores value in a cache for a a period of time set by settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS.
+    Uses the subscription info stored in the cache by is_subscribed_and_cancelled_time_with_cache.
     This reduces the number of queries needed to the Stripe API.
     """
-    product_id = product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
-    cache = _get_subscription_cache()
-    cache_key = f'is_subscribed_{user.id}_{product_id}'
-    subscribed = cache.get(cache_key)
-    if subscribed is None:
-        logger.debug('Retrieving subscription data with cache key %s for user %s for product %s', cache_key, user.id,
-                     product_id)
-        subscribed = is_subscribed(user, product_id)
-        if subscribed:
-            logger.debug('Setting cache key %s for user %s subscription: %s', cache_key, user.id, subscribed, )
-            cache.set(cache_key, subscribed, timeout=settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS)
-    return subscribed
+    return bool(is_subscribed_and_cancelled_time_with_cache(user, product_id)['sub_id'])
+
+
+def get_subscribed_prices_with_cache(user: Optional[DjangoUserProtocol], product_id: str) -> Dict[str, SubscriptionInfo]:
+    """
+    Return the subscription info for the price of the user's subscription to the product, keyed by price_id,
+    from the same cache entry as is_subscribed_with_cache.
+    """
+    if not user or not user.stripe_customer_id:
+        return {}
+    sub_info = is_subscribed_and_cancelled_time_with_cache(user, product_id)
+    if not sub_info['sub_id'] or sub_info['evaluation']:
+        return {}
+    return {sub_info['price_id']: {'sub_id': sub_info['sub_id'], 'cancel_at': sub_info['cancel_at'],
+                                   'current_period_end': sub_info['current_period_end']}}
+
+
+@get_actual_user
+def get_entitlements_with_cache(user) -> Entitlements:
+    """
+    Return get_entitlements for the user, stored as a single entry per user in the Stripe Subscription Cache
+    until the first of the active subscriptions ends, as given by get_subscription_cache_timeout.
+    Entitlements without any active subscriptions are only cached for
+    settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS.
+    An empty dict is returned if there is no logged in user.
+    """
+    if not user:
+        return {}
+    cache_key = entitlements_cache_key(user)
+    entitlements = subscription_cache.get(cache_key)
+    if entitlements is None:
+        logger.debug('Retrieving entitlements with cache key %s for user %s', cache_key, user.id)
+        entitlements = get_entitlements(user)
+        entitled = [entitlement for entitlement in entitlements['products'].values()
+                    if entitlement['status'] in entitled_statuses]
+        if entitled:
+            timeout = get_subscription_cache_timeout(entitled)
+        else:
+            timeout = settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS
+        if timeout != 0:
+            subscription_cache.set(cache_key, entitlements, timeout=timeout, notify=False)
+    return entitlements
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from .conf import settings
 
 """
 All serializers be subclassed and changed accordingly such as adding new fields which will then be passed to the Stripe API.
@@ -65,3 +66,24 @@ class InvoiceSerializer(serializers.Serializer):
         ('void', 'void'),
     ), required=False)
     subscription = serializers.CharField(max_length=255, required=False)
+
+
+class BatchSubRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=('GET', 'POST', 'PUT', 'DELETE'), default='GET')
+    path = serializers.CharField(max_length=2048)
+    data = serializers.JSONField(required=False, default=dict)
+
+    def validate_path(self, value):
+        if not value.startswith('/'):
+            raise serializers.ValidationError("The path must be absolute, e.g. /api/products/")
+        return value
+
+
+class BatchSerializer(serializers.Serializer):
+    requests = BatchSubRequestSerializer(many=True, allow_empty=False)
+
+    def validate_requests(self, value):
+        if len(value) > settings.STRIPE_BATCH_MAX_REQUESTS:
+            raise serializers.ValidationError(
+                f"A batch can contain at most {settings.STRIPE_BATCH_MAX_REQUESTS} requests.")
+        return value
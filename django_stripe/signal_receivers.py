@@ -1,12 +1,16 @@
 from django.conf import settings
 from django.dispatch import receiver
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.contrib.auth import get_user_model
 from .conf import settings
 import stripe
 from .logging import logger
-from .payments import modify_customer
-from .utils import user_description
+from . import signals
+from .payments import (modify_customer, create_customer_for_user_id, update_user_subscription_status,
+                       update_subscription_cache)
+from .operations import enqueue_sync_customer_details
+from .utils import get_customer_details_changes, run_in_background
 
 
 from typing import Optional, Tuple
@@ -25,17 +29,46 @@ def modify_email_if_changed_receiver(instance, created: bool,
     2) If this is a modify request
     3) If the customer already exists on Stripe
     4) If this was prompted by User.save(update_fields=....) then is email, first_name or last_name included in the update_fields.
+    If settings.STRIPE_USE_OPERATION_QUEUE is True, the update is queued for the stripe_worker command.
     """
     if settings.STRIPE_KEEP_CUSTOMER_DETAILS_UPDATED and not created and instance.stripe_customer_id and (
             not update_fields or any(f in update_fields for f in ('email', 'first_name', 'last_name'))):
+        if settings.STRIPE_USE_OPERATION_QUEUE:
+            enqueue_sync_customer_details(instance.stripe_customer_id)
+            return
         logger.debug("Updating user %d email in Stripe", instance.id)
         customer = stripe.Customer.retrieve(instance.stripe_customer_id)
-        modify_kwargs = {}
-        if customer['email'] != instance.email:
-            modify_kwargs['email'] = instance.email
-        description = user_description(instance)
-        if customer['description'] != description:
-            modify_kwargs['description'] = description
+        modify_kwargs = get_customer_details_changes(instance, customer)
         if modify_kwargs:
             modify_customer(instance, **modify_kwargs)
 
+
+@receiver(post_save, sender=User)
+def create_customer_on_signup_receiver(instance, created: bool, **kwargs):
+    """
+    A signal receiver which creates the Stripe customer for a new user in the background if settings.STRIPE_CREATE_CUSTOMER_ON_SIGNUP is True.
+    The customer is created once the transaction which created the user is committed,
+    so the first visit to a checkout or the subscription portal does not need to wait for it.
+    """
+    if settings.STRIPE_CREATE_CUSTOMER_ON_SIGNUP and created and not instance.stripe_customer_id:
+        user_id = instance.id
+        logger.debug("Scheduling creation of user %s on stripe", user_id)
+        transaction.on_commit(lambda: run_in_background(create_customer_for_user_id, user_id))
+
+
+@receiver([signals.subscription_created, signals.subscription_modified, signals.subscription_cancelled])
+def update_subscription_status_receiver(sender, subscription, **kwargs):
+    """
+    A signal receiver which keeps the subscription status stored on the user updated, if the user model has the fields
+    from django_stripe.models.StripeSubscriptionUser.
+    """
+    update_user_subscription_status(sender, subscription)
+
+
+@receiver([signals.subscription_created, signals.subscription_modified, signals.subscription_cancelled])
+def update_subscription_cache_receiver(sender, subscription, **kwargs):
+    """
+    A signal receiver which writes subscriptions created, modified or cancelled through django_stripe to the
+    Stripe Subscription Cache, so is_subscribed_with_cache does not return an out of date result.
+    """
+    update_subscription_cache(sender, subscription)
@@ -1,4 +1,5 @@
-from subscriptions.types import Protocol, UserProtocol, ProductIsSubscribed
+from subscriptions.types import Protocol, TypedDict, UserProtocol, ProductIsSubscribed
+from typing import Dict, List, Optional
 
 
 class DjangoUserProtocol(UserProtocol, Protocol):
@@ -10,3 +11,17 @@ class DjangoUserProtocol(UserProtocol, Protocol):
 
 class SubscriptionInfoWithEvaluation(ProductIsSubscribed):
     evaluation: bool
+
+
+class ProductEntitlement(TypedDict):
+    sub_id: str
+    price_id: Optional[str]
+    status: str
+    current_period_end: Optional[int]
+    cancel_at: Optional[int]
+    features: List[str]
+
+
+class Entitlements(TypedDict):
+    products: Dict[str, ProductEntitlement]
+    features: List[str]
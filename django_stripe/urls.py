@@ -1,7 +1,8 @@
 from django.urls import path, re_path
 from .views import (
     StripeSetupCheckoutView, StripePriceCheckoutView, StripeBillingPortalView, StripePricesView, StripeProductsView,
-    StripeSetupIntentView, StripePaymentMethodView, StripeSubscriptionView, StripeInvoiceView
+    StripeSetupIntentView, StripePaymentMethodView, StripeSubscriptionView, StripeInvoiceView, StripeBatchView,
+    StripeWebhookView
 )
 
 
@@ -14,5 +15,7 @@ urlpatterns = [
     path('setup-intents', StripeSetupIntentView.as_view(), name="setup-intents"),
     re_path(r'^payment-methods/(?:(?P<obj_id>.*)/)?', StripePaymentMethodView.as_view(), name="payment-methods"),
     re_path(r'^subscriptions/(?:(?P<obj_id>.*)/)?', StripeSubscriptionView.as_view(), name="subscriptions"),
-    re_path(r'^invoices/(?:(?P<obj_id>.*)/)?', StripeInvoiceView.as_view(), name="invoices")
+    re_path(r'^invoices/(?:(?P<obj_id>.*)/)?', StripeInvoiceView.as_view(), name="invoices"),
+    path('batch/', StripeBatchView.as_view(), name="batch"),
+    path('webhook/', StripeWebhookView.as_view(), name="webhook")
 ]
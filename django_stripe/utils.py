@@ -1,10 +1,11 @@
-from django.db import models
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.db import models, connections
 from django.contrib.auth import get_user_model
 from functools import wraps
-from typing import Any
+from typing import Any, Callable, Dict, Mapping
 
 
-User = get_user_model()
+executor = ThreadPoolExecutor(thread_name_prefix='django_stripe')
 
 
 def get_user_if_token_user(user: Any):
@@ -17,7 +18,7 @@ def get_user_if_token_user(user: Any):
         if not user.is_authenticated:
             return None
         elif not isinstance(user, models.Model):
-            return User.objects.get(id=user.id)
+            return get_user_model().objects.get(id=user.id)
     return user
 
 
@@ -38,3 +39,32 @@ def user_description(user) -> str:
     The description sent to Stripe when a customer is created or modified
     """
     return f'{user.first_name} {user.last_name}'
+
+
+def get_customer_details_changes(user, customer: Mapping[str, Any]) -> Dict[str, str]:
+    """
+    Compare the user's email and description with the values stored for the Stripe customer.
+    Returns the kwargs needed for stripe.Customer.modify to bring the customer up to date, empty if nothing changed.
+    """
+    modify_kwargs = {}
+    if customer['email'] != user.email:
+        modify_kwargs['email'] = user.email
+    description = user_description(user)
+    if customer['description'] != description:
+        modify_kwargs['description'] = description
+    return modify_kwargs
+
+
+def _close_connections_after(f: Callable, *args, **kwargs) -> Any:
+    try:
+        return f(*args, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def run_in_background(f: Callable, *args, **kwargs) -> Future:
+    """
+    Run a function in the django_stripe thread pool.
+    Database connections opened by the worker thread are closed when the function completes.
+    """
+    return executor.submit(_close_connections_after, f, *args, **kwargs)
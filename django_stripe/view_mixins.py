@@ -1,16 +1,22 @@
+import hashlib
+import json
 import stripe
 import logging
 
 from operator import itemgetter
 
 import subscriptions.exceptions
-from stripe.error import StripeError
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from .conf import settings
+from .deadline import stripe_deadline
 from django_stripe import payments, exceptions
-from .logging import logger
+from .logging import logger, stripe_error_log
 from subscriptions.types import Protocol
 from typing import Dict, Any, Callable, List, Type, Union, Iterable, Optional
 
@@ -25,9 +31,31 @@ class StripeViewMixin(Protocol):
     response_keys: tuple = ("id", "created")
     response_keys_exclude: tuple = None
     key_rename: dict = {}
+    expand_fields: tuple = ()
+    stripe_deadline_seconds: Optional[float] = None
 
     def make_request(self, request: Request, **data) -> DataType: ...
 
+    def get_query_list(self, name: str) -> List[str]:
+        """
+        Values of a query parameter given either comma-separated or repeated, e.g. ?fields=id,status&fields=created
+        """
+        request = getattr(self, 'request', None)
+        if not request:
+            return []
+        return [v.strip() for value in request.query_params.getlist(name) for v in value.split(',') if v.strip()]
+
+    def get_expand(self) -> List[str]:
+        """
+        Fields to expand in the Stripe API request, from the ?expand= query parameter.
+        Only fields in self.expand_fields are allowed.
+        """
+        expand = self.get_query_list('expand')
+        not_allowed = [f for f in expand if f not in self.expand_fields]
+        if not_allowed:
+            raise ValidationError({'expand': [f"Cannot expand {', '.join(not_allowed)}. Allowed: {', '.join(self.expand_fields) or 'none'}"]})
+        return expand
+
     @property
     def name_in_errors(self) -> str:
         return self.stripe_resource.__name__
@@ -45,7 +73,7 @@ class StripeViewMixin(Protocol):
             value = value[k]
         return value
 
-    def make_response(self, item: Dict[str, Any]) -> Dict[str, Any]:
+    def filter_keys(self, item: Dict[str, Any]) -> Dict[str, Any]:
         """
         Filter which keys are returned in the response.
         """
@@ -55,6 +83,26 @@ class StripeViewMixin(Protocol):
             return {self.get_key(k): self.get_value(item, k) for k in self.response_keys}
         return item
 
+    def select_fields(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        If the client requested specific fields with ?fields=, narrow the response down to those.
+        """
+        fields = self.get_query_list('fields')
+        if fields:
+            return {k: v for k, v in item.items() if k in fields}
+        return item
+
+    def make_response(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        return self.select_fields(self.filter_keys(item))
+
+    def get_stripe_deadline(self) -> Optional[float]:
+        """
+        Time budget in seconds for all requests to the Stripe API made by this view.
+        """
+        if self.stripe_deadline_seconds is not None:
+            return self.stripe_deadline_seconds
+        return settings.STRIPE_DEADLINE_SECONDS
+
     def run_stripe(self, request: Request, method: Callable = None, **data) -> DataType:
         """
         Run a request to the Stripe API and convert any Exceptions to a Rest Framework Exception.
@@ -62,10 +110,11 @@ class StripeViewMixin(Protocol):
         """
         method = method or self.make_request
         try:
-            return method(request, **data)
+            with stripe_deadline(self.get_stripe_deadline()):
+                return method(request, **data)
         except stripe.error.StripeError as e:
-            logger.exception(e, exc_info=e)
-            raise exceptions.StripeException(detail=e)
+            stripe_error_log.log(e, request)
+            raise exceptions.StripeException.from_stripe_error(e)
 
     def run_stripe_response(self, request: Request, method: Callable = None,
                             status_code: int = None, **data) -> Response:
@@ -120,38 +169,87 @@ class StripeViewWithSerializerMixin(StripeViewMixin, Protocol):
 class StripeListMixin(StripeViewWithSerializerMixin, Protocol):
     order_by: tuple = ("created", "id")
     order_reverse: bool = True
+    use_etags: bool = True
 
     def list(self, request: Request, **kwargs) -> Iterable[Dict[str, Any]]:
         return payments.list_customer_resource(request.user, self.stripe_resource, **kwargs)
 
-    def retrieve(self, request: Request, obj_id: str) -> Dict[str, Any]:
-        return payments.retrieve(request.user, self.stripe_resource, obj_id)
+    def retrieve(self, request: Request, obj_id: str, **kwargs) -> Dict[str, Any]:
+        return payments.retrieve(request.user, self.stripe_resource, obj_id, **kwargs)
 
     def prepare_list(self, items: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        return sorted(
-            [self.make_response(item) for item in items],
+        """
+        Items are sorted before narrowing to the requested fields, so the sort keys do not need to be requested.
+        """
+        items = sorted(
+            [self.filter_keys(item) for item in items],
             key=itemgetter(*self.order_by), reverse=self.order_reverse
         )
+        return [self.select_fields(item) for item in items]
 
     def get_list(self, request: Request, **data) -> List[Dict[str, Any]]:
         return self.prepare_list(self.list(request, **data))
 
-    def get_one(self, request: Request, obj_id: str) -> Dict[str, Any]:
+    def get_one(self, request: Request, obj_id: str, **kwargs) -> Dict[str, Any]:
         """
         Returns an exception if a user tries to view an object belonging to another user.
         Rather than giving a permission error, they are told the object does not exist at all.
         """
         try:
-            return self.make_response(self.retrieve(request, obj_id))
+            return self.make_response(self.retrieve(request, obj_id, **kwargs))
         except subscriptions.exceptions.StripeWrongCustomer as e:
             user = f'User {request.user.id}' if request.user and request.user.is_authenticated else "Unauthenticated User"
             logger.warning("%s attempted to access object they do not own: %s. %s", user, obj_id, e)
             raise exceptions.StripeException(f"No such {self.name_in_errors}: '{obj_id}'")
 
+    @staticmethod
+    def make_etag(data: DataType) -> str:
+        """
+        A strong ETag computed from the data in the response, after filtering keys with self.response_keys.
+        """
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def conditional_response(self, request: Request, response: Response) -> Response:
+        """
+        Adds an ETag header to successful responses.
+        If the ETag matches the If-None-Match header in the request, a 304 Not Modified response without a body is returned instead.
+        """
+        if not self.use_etags or response.status_code != status.HTTP_200_OK:
+            return response
+        etag = quote_etag(self.make_etag(response.data))
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+
     def get(self, request: Request, **kwargs) -> Response:
+        expand = self.get_expand()
         if kwargs:
-            return self.run_stripe_response(request, method=self.get_one, status_code=status.HTTP_200_OK, **kwargs)
-        return self.run_serialized_stripe_response(request, method=self.get_list, status_code=status.HTTP_200_OK)
+            if expand:
+                kwargs['expand'] = expand
+            response = self.run_stripe_response(request, method=self.get_one, status_code=status.HTTP_200_OK, **kwargs)
+        else:
+            list_kwargs = {'expand': [f'data.{f}' for f in expand]} if expand else {}
+            response = self.run_serialized_stripe_response(request, method=self.get_list,
+                                                           status_code=status.HTTP_200_OK, **list_kwargs)
+        return self.conditional_response(request, response)
+
+
+class StripeCatalogMixin(StripeListMixin, Protocol):
+    """
+    For products and prices. Responses to anonymous users are the same for everyone, so they can be stored by shared caches such as a CDN.
+    Responses to authenticated users contain their subscription info, so they are private.
+    """
+    def get(self, request: Request, **kwargs) -> Response:
+        response = super().get(request, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            if request.user and request.user.is_authenticated:
+                patch_cache_control(response, private=True)
+            else:
+                patch_cache_control(response, public=True, max_age=settings.STRIPE_CATALOG_CACHE_TIMEOUT_SECONDS)
+            patch_vary_headers(response, ('Cookie', 'Authorization'))
+        return response
 
 
 class StripeCreateMixin(StripeViewMixin, Protocol):
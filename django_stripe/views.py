@@ -1,19 +1,32 @@
 import datetime
+import io
+import json
 
 import stripe
+import stripe.error
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import RedirectView, TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.urls import reverse
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, QueryDict
+from django.urls import reverse, resolve, Resolver404
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
+from rest_framework.response import Response
 from rest_framework.views import APIView
 from .conf import settings
 from . import serializers
 from . import payments
-from .utils import get_user_if_token_user
+from . import webhooks
+from .deadline import stripe_deadline
+from .utils import get_user_if_token_user, run_in_background, _close_connections_after
 from .logging import logger
-from .view_mixins import StripeListMixin, StripeCreateMixin, StripeCreateWithSerializerMixin, StripeModifyMixin, StripeDeleteMixin
+from .view_mixins import StripeViewMixin, StripeListMixin, StripeCatalogMixin, StripeCreateMixin, StripeCreateWithSerializerMixin, StripeModifyMixin, StripeDeleteMixin
 from typing import Dict, Any, List, Iterable, Optional
 
 
@@ -62,7 +75,7 @@ class StripeSetupIntentView(APIView, StripeCreateMixin):
         return payments.create_setup_intent(request.user, **data)
 
 
-class StripePricesView(APIView, StripeListMixin):
+class StripePricesView(APIView, StripeCatalogMixin):
     """
     An API View for listing and retrieving prices including subscription information if the user is authenticated.
     Methods Supported: GET
@@ -80,7 +93,7 @@ class StripePricesView(APIView, StripeListMixin):
         return payments.retrieve_price(request.user, price_id, rest=True)
 
 
-class StripeProductsView(APIView, StripeListMixin):
+class StripeProductsView(APIView, StripeCatalogMixin):
     """
     An API View for listing and retrieving products including subscription information if the user is authenticated.
     Methods Supported: GET
@@ -109,6 +122,7 @@ class StripeInvoiceView(APIView, StripeListMixin):
     permission_classes = (IsAuthenticated,)
     response_keys = ('id', "amount_due", "amount_paid", "amount_remaining", "billing_reason",
                      "created", "hosted_invoice_url", "invoice_pdf", "next_payment_attempt", "status", "subscription")
+    expand_fields = ('subscription',)
 
     @property
     def name_in_errors(self) -> str:
@@ -166,6 +180,7 @@ class StripeSubscriptionView(APIView, StripeListMixin, StripeCreateWithSerialize
     response_keys = ('id', 'created', 'plan__product', 'plan__id', 'cancel_at', 'current_period_end',
                      'current_period_start', 'days_until_due', 'default_payment_method', 'latest_invoice',
                      'start_date', 'status', 'trial_end', 'trial_start')
+    expand_fields = ('default_payment_method', 'latest_invoice')
 
     @property
     def name_in_errors(self) -> str:
@@ -178,6 +193,104 @@ class StripeSubscriptionView(APIView, StripeListMixin, StripeCreateWithSerialize
         return payments.modify_subscription(request.user, sub_id, **data)
 
 
+class StripeBatchView(APIView):
+    """
+    An API View for making several requests to the other django_stripe API views in one HTTP request.
+    Each sub-request has a method, an absolute path and optional data, which is sent as query parameters for GET
+    requests and as a JSON body otherwise. Sub-requests are authenticated and checked with the same credentials as
+    the batch request. GET sub-requests run in parallel; other sub-requests run one at a time in the order given.
+    The response contains the status and data of each sub-request, in the same order.
+    Methods Supported: POST
+    """
+    throttle_scope = 'payments'
+    serializer_class = serializers.BatchSerializer
+
+    @staticmethod
+    def make_sub_request(request: Request, method: str, path: str, data: Dict[str, Any]) -> HttpRequest:
+        url = urlsplit(path)
+        query = QueryDict(url.query, mutable=True)
+        if method == 'GET':
+            for key, value in data.items():
+                query.setlist(key, [str(v) for v in value] if isinstance(value, list) else [str(value)])
+            body = b''
+        else:
+            body = json.dumps(data).encode()
+        sub_request = HttpRequest()
+        sub_request.method = method
+        sub_request.path = sub_request.path_info = url.path
+        sub_request.GET = query
+        sub_request.COOKIES = request._request.COOKIES
+        sub_request.META = {**request._request.META, 'REQUEST_METHOD': method, 'PATH_INFO': url.path,
+                            'QUERY_STRING': query.urlencode(), 'CONTENT_TYPE': 'application/json',
+                            'CONTENT_LENGTH': str(len(body))}
+        sub_request._stream = io.BytesIO(body)
+        sub_request.user = request.user
+        for attr in ('session', '_dont_enforce_csrf_checks'):
+            if hasattr(request._request, attr):
+                setattr(sub_request, attr, getattr(request._request, attr))
+        return sub_request
+
+    def run_sub_request(self, request: Request, method: str, path: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            match = resolve(urlsplit(path).path)
+        except Resolver404:
+            match = None
+        view_class = getattr(match, 'func', None) and getattr(match.func, 'cls', None)
+        if not view_class or StripeViewMixin not in view_class.__mro__:
+            return {'status': status.HTTP_404_NOT_FOUND, 'data': {'detail': f'No django_stripe view for {path}'}}
+        sub_request = self.make_sub_request(request, method, path, data)
+        sub_request.resolver_match = match
+        try:
+            response = match.func(sub_request, *match.args, **match.kwargs)
+        except Exception as e:
+            logger.exception('Error in batch request %s %s', method, path, exc_info=e)
+            return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'data': {'detail': 'Internal server error'}}
+        return {'status': response.status_code, 'data': getattr(response, 'data', None)}
+
+    def post(self, request: Request) -> Response:
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        sub_requests = serializer.validated_data['requests']
+        get_requests = {i: r for i, r in enumerate(sub_requests) if r['method'] == 'GET'}
+        # GET sub-requests get their own threads rather than the shared django_stripe pool, as the views submit work
+        # to that pool and wait for it, which would deadlock once all of its threads were running sub-requests
+        with ThreadPoolExecutor(max_workers=max(len(get_requests), 1),
+                                thread_name_prefix='django_stripe_batch') as batch_executor:
+            futures = {i: batch_executor.submit(_close_connections_after, self.run_sub_request, request, **r)
+                       for i, r in get_requests.items()}
+            results = {i: self.run_sub_request(request, **r)
+                       for i, r in enumerate(sub_requests) if r['method'] != 'GET'}
+            results.update({i: f.result() for i, f in futures.items()})
+        return Response({'responses': [results[i] for i in range(len(sub_requests))]})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhookView(View):
+    """
+    Receives events from Stripe webhooks. The signature is verified with settings.STRIPE_WEBHOOK_SECRET and the event is
+    stored with a single insert before responding, so Stripe gets a response straight away even when it is retrying
+    many deliveries. Duplicate deliveries are ignored. Events are applied afterwards by
+    django_stripe.webhooks.process_events, in a background thread if settings.STRIPE_WEBHOOK_PROCESS_IN_BACKGROUND is True
+    or otherwise by the stripe_process_events command.
+    Methods Supported: POST
+    """
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs) -> HttpResponse:
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            logger.error('Received a Stripe webhook but STRIPE_WEBHOOK_SECRET is not set')
+            return HttpResponseBadRequest()
+        try:
+            event = webhooks.construct_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            logger.warning('Invalid Stripe webhook request: %s', e)
+            return HttpResponseBadRequest()
+        webhooks.store_events([event])
+        if settings.STRIPE_WEBHOOK_PROCESS_IN_BACKGROUND:
+            transaction.on_commit(lambda: run_in_background(webhooks.process_events_in_background))
+        return HttpResponse()
+
+
 class GoToSetupCheckoutView(LoginRequiredMixin, TemplateView):
     """
     A regular Django view for redirecting a user to a newly created Stripe Setup Checkout session.
@@ -223,14 +336,21 @@ class BaseCheckoutView(LoginRequiredMixin, TemplateView):
     """
     product_id: str = None
     date_format: str = "%A %d %B %Y"
+    stripe_deadline_seconds: Optional[float] = None
 
     def get_product_id(self) -> str:
         return self.product_id or settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID
 
+    def get_stripe_deadline(self) -> Optional[float]:
+        if self.stripe_deadline_seconds is not None:
+            return self.stripe_deadline_seconds
+        return settings.STRIPE_DEADLINE_SECONDS
+
     def get(self, request, *args, **kwargs):
-        if request.user and request.user.is_authenticated:
-            payments.create_customer(request.user)
-        return super().get(request, *args, **kwargs)
+        with stripe_deadline(self.get_stripe_deadline()):
+            if request.user and request.user.is_authenticated:
+                payments.create_customer(request.user)
+            return super().get(request, *args, **kwargs)
 
     def get_default_country(self):
         country = None
@@ -252,29 +372,44 @@ class SubscriptionPortalView(BaseCheckoutView):
     Methods Supported: GET
     """
     template_name = 'django_stripe/subscription_portal.html'
+    currency: Optional[str] = None
+
+    def get_currency(self) -> Optional[str]:
+        return self.currency
+
+    def get_product(self, user) -> Dict[str, Any]:
+        """
+        The product and its prices come from the shared catalog cache, keyed by product and currency.
+        Only the subscription info is retrieved for each user.
+        """
+        currency = self.get_currency()
+        price_kwargs = {'currency': currency} if currency else None
+        return payments.retrieve_product(user, self.get_product_id(), price_kwargs=price_kwargs)
+
+    def get_js_config(self, user, subscription_info: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'subscriptionInfo': subscription_info,
+            'user_email': user.email,
+            'country': self.get_default_country(),
+            'hide_postal_code': settings.STRIPE_CREDIT_CARD_HIDE_POSTAL_CODE,
+            'stripePublishableKey': settings.STRIPE_PUBLISHABLE_KEY,
+            'paymentMethods': settings.STRIPE_PAYMENT_METHOD_TYPES,
+            'subscription_api_url': reverse("subscriptions"),
+            'setup_intents_url': reverse("setup-intents")
+        }
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = get_user_if_token_user(self.request.user)
-        product_id = self.get_product_id()
-        logger.debug("Opening payments portal for user %d, product %s", user.id, product_id)
-        context['product'] = payments.retrieve_product(user, product_id)
+        logger.debug("Opening payments portal for user %d, product %s", user.id, self.get_product_id())
+        context['product'] = self.get_product(user)
         context['product']['subscription_info']['current_period_end'] = self.timestamp_format(context['product']['subscription_info']['current_period_end'])
         context['product']['subscription_info']['cancel_at'] = self.timestamp_format(context['product']['subscription_info']['cancel_at'])
         context['dev_mode'] = settings.STRIPE_CHECKOUT_DEV_MODE and 'test' in settings.STRIPE_PUBLISHABLE_KEY
         context['title'] = settings.STRIPE_CHECKOUT_TITLE
         context['header_link'] = reverse("subscription-history")
         context['header_link_text'] = "Subscription History"
-        context['js_config'] = {
-            'subscriptionInfo': context['product']['subscription_info'],
-            'user_email': user.email,
-            'country': self.get_default_country(),
-            'hide_postal_code': settings.STRIPE_CREDIT_CARD_HIDE_POSTAL_CODE,
-            'stripePublishableKey': settings.STRIPE_PUBLISHABLE_KEY,
-            'paymentMethods': settings.STRIPE_PAYMENT_METHOD_TYPES,
-            'subscription_api_url': reverse("subscriptions"),
-            'setup_intents_url': reverse("setup-intents")
-        }
+        context['js_config'] = self.get_js_config(user, context['product']['subscription_info'])
         return context
 
 
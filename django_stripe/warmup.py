@@ -0,0 +1,37 @@
+import time
+from django.core.cache import caches
+
+from .conf import settings
+from .checks import check_settings
+from .exceptions import ConfigurationException
+from .logging import logger
+from . import catalog
+
+
+def warm_up() -> float:
+    """
+    Prepare the process to handle requests so the first requests after a deploy are not slowed down:
+    settings are checked, views are imported, connections to the caches and to the Stripe API are opened
+    and the default product and the index of allowed prices are loaded.
+    Failures are logged and do not stop the remaining steps. Returns the time taken in seconds.
+    """
+    start = time.monotonic()
+    for message in check_settings():
+        logger.log(message.level, '%s: %s', message.id, message.msg)
+    from . import views  # noqa: F401 (imported here rather than on the first request)
+    for name in {settings.STRIPE_SUBSCRIPTION_CACHE_NAME, settings.STRIPE_CATALOG_CACHE_NAME}:
+        try:
+            caches[name].get('django_stripe_warm_up')
+        except Exception as e:
+            logger.warning('Unable to warm up cache %s: %s', name, e)
+    try:
+        catalog.retrieve_product(settings.STRIPE_DEFAULT_SUBSCRIPTION_PRODUCT_ID)
+        if settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS is not None:
+            catalog.refresh_price_index()
+    except ConfigurationException:
+        pass
+    except Exception as e:
+        logger.warning('Unable to load the Stripe catalog during warm up: %s', e)
+    duration = time.monotonic() - start
+    logger.info('django_stripe warm up completed in %.0f ms', duration * 1000)
+    return duration
@@ -0,0 +1,194 @@
+import datetime
+import json
+import stripe
+import stripe.error
+import threading
+import time
+from collections import Counter
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from .conf import settings
+from .logging import logger
+from .models import StripeEvent, StripeEventCursor
+from . import catalog, payments
+
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+
+
+handlers: Dict[str, List[Callable[[Mapping[str, Any]], Any]]] = {}
+
+_processing_lock = threading.Lock()
+_processing_requested = threading.Event()
+
+
+def register_event_handler(*event_types: str) -> Callable:
+    """
+    Register a function to apply events of the given types. The function is called with the event's data object.
+    Events for the same object are applied in the order they were created on Stripe, and an event older than one
+    already applied for the same object is skipped.
+    """
+    def decorator(f: Callable[[Mapping[str, Any]], Any]) -> Callable[[Mapping[str, Any]], Any]:
+        for event_type in event_types:
+            handlers.setdefault(event_type, []).append(f)
+        return f
+    return decorator
+
+
+def construct_event(payload: bytes, signature: str) -> Mapping[str, Any]:
+    """
+    Verify the Stripe-Signature header of a webhook request with settings.STRIPE_WEBHOOK_SECRET and return the event.
+    Raises ValueError or stripe.error.SignatureVerificationError if the payload cannot be trusted.
+    """
+    stripe.WebhookSignature.verify_header(payload.decode('utf-8'), signature, settings.STRIPE_WEBHOOK_SECRET,
+                                          stripe.Webhook.DEFAULT_TOLERANCE)
+    return json.loads(payload)
+
+
+def store_events(events: Iterable[Mapping[str, Any]]) -> None:
+    """
+    Store received events with a single insert. Events which have already been received are ignored.
+    """
+    StripeEvent.objects.bulk_create([StripeEvent(
+        event_id=event['id'], type=event['type'], object_id=event['data']['object'].get('id') or '',
+        data=event['data']['object'], created=datetime.datetime.fromtimestamp(event['created'], tz=datetime.timezone.utc))
+        for event in events], ignore_conflicts=True)
+
+
+def _event_list_kwargs(page_size: int) -> Dict[str, Any]:
+    kwargs = {'limit': page_size}
+    # The Events API accepts up to 20 types, otherwise all events are listed
+    if len(handlers) <= 20:
+        kwargs['types'] = sorted(handlers)
+    return kwargs
+
+
+def poll_events(cursor_name: str = 'default', backfill_seconds: Optional[float] = None, page_size: int = 100) -> int:
+    """
+    Store the events created since the last poll from the Stripe Events API, for use where webhooks cannot be received.
+    Only event types with a registered handler are requested. The id of the newest event is stored as a cursor after
+    each page so the next poll continues from there. On the first poll, events created in the last backfill_seconds
+    are stored, or if backfill_seconds is None, no events are stored and polling starts from the newest event.
+    Returns the number of events retrieved.
+    """
+    cursor, _ = StripeEventCursor.objects.get_or_create(name=cursor_name)
+    kwargs = _event_list_kwargs(page_size)
+    if not cursor.event_id:
+        if backfill_seconds is None:
+            events = stripe.Event.list(**{**kwargs, 'limit': 1})['data']
+        else:
+            events = list(stripe.Event.list(created={'gte': int(time.time() - backfill_seconds)},
+                                            **kwargs).auto_paging_iter())
+            store_events(events)
+        if events:
+            cursor.event_id = events[0]['id']
+            cursor.save(update_fields=['event_id', 'updated'])
+        return len(events) if backfill_seconds is not None else 0
+    count = 0
+    while True:
+        try:
+            page = stripe.Event.list(ending_before=cursor.event_id, **kwargs)
+        except stripe.error.InvalidRequestError as e:
+            logger.error('Resetting Stripe events cursor %s as %s could not be used: %s', cursor_name,
+                         cursor.event_id, e)
+            cursor.event_id = ''
+            cursor.save(update_fields=['event_id', 'updated'])
+            return count
+        if page['data']:
+            store_events(page['data'])
+            count += len(page['data'])
+            cursor.event_id = page['data'][0]['id']
+            cursor.save(update_fields=['event_id', 'updated'])
+        if not page['has_more'] or not page['data']:
+            return count
+
+
+def poll_and_process_events(**kwargs) -> Counter:
+    """
+    Store new events from the Stripe Events API and apply them. Can be run periodically by a task scheduler.
+    kwargs are passed to poll_events.
+    """
+    poll_events(**kwargs)
+    return process_events()
+
+
+def apply_event(event: StripeEvent) -> str:
+    """
+    Apply a claimed event with the registered handlers, unless an event created later for the same object has already
+    been applied. Returns the new status of the event.
+    """
+    if StripeEvent.objects.filter(object_id=event.object_id, status=StripeEvent.APPLIED,
+                                  created__gt=event.created).exists():
+        logger.debug('Skipping %s as a newer event for %s has been applied', event, event.object_id)
+        status, error = StripeEvent.SKIPPED, ''
+    else:
+        try:
+            for handler in handlers.get(event.type, []):
+                handler(event.data)
+            status, error = StripeEvent.APPLIED, ''
+        except Exception as e:
+            logger.exception('Failed to apply Stripe event %s: %s', event, e)
+            status, error = StripeEvent.FAILED, str(e)
+    StripeEvent.objects.filter(id=event.id).update(status=status, processed=timezone.now(), last_error=error)
+    return status
+
+
+def process_events(limit: int = 100) -> Counter:
+    """
+    Apply pending events, oldest first, until there are none left.
+    Each event is claimed before it is applied so several processors can run at once.
+    Returns the number of events with each resulting status.
+    """
+    results = Counter()
+    while True:
+        events = list(StripeEvent.objects.filter(status=StripeEvent.PENDING)[:limit])
+        for event in events:
+            if StripeEvent.objects.filter(id=event.id, status=StripeEvent.PENDING).update(
+                    status=StripeEvent.PROCESSING):
+                results[apply_event(event)] += 1
+        if len(events) < limit:
+            return results
+
+
+def process_events_in_background() -> None:
+    """
+    Process pending events in the current thread unless another thread in this process is already processing them,
+    in which case that thread processes them once it has finished its current batch.
+    """
+    _processing_requested.set()
+    while _processing_requested.is_set() and _processing_lock.acquire(blocking=False):
+        try:
+            while _processing_requested.is_set():
+                _processing_requested.clear()
+                process_events()
+        finally:
+            _processing_lock.release()
+
+
+@register_event_handler('customer.subscription.created', 'customer.subscription.updated',
+                        'customer.subscription.deleted')
+def update_subscription(subscription: Mapping[str, Any]) -> None:
+    """
+    Store the subscription status on the user, if the user model has the fields, and write it to the
+    subscription cache so the change is seen straight away.
+    """
+    User = get_user_model()
+    user = User.objects.filter(stripe_customer_id=subscription['customer']).first()
+    if user:
+        payments.update_user_subscription_status(user, subscription)
+        payments.update_subscription_cache(user, subscription)
+
+
+@register_event_handler('customer.deleted')
+def remove_customer_id(customer: Mapping[str, Any]) -> None:
+    """
+    Remove the id of a customer deleted on Stripe from the user, so a new customer is created when it is next needed.
+    """
+    User = get_user_model()
+    User.objects.filter(stripe_customer_id=customer['id']).update(stripe_customer_id=None)
+
+
+@register_event_handler('product.created', 'product.updated', 'product.deleted',
+                        'price.created', 'price.updated', 'price.deleted')
+def update_catalog(obj: Mapping[str, Any]) -> None:
+    catalog.invalidate_catalog()
@@ -1,6 +1,6 @@
 from django.db import models
-from django_stripe.models import StripeCustomerUser
+from django_stripe.models import StripeSubscriptionUser
 
 
-class User(StripeCustomerUser):
+class User(StripeSubscriptionUser):
     allowed_access_until = models.DateTimeField(blank=True, null=True)
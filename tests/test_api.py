@@ -1,8 +1,15 @@
+import json
+import logging
 import pytest
 import stripe
-
-from django_stripe.tests import assert_customer_id_exists, make_request
-from django_stripe import payments, signals
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django_stripe.tests import assert_customer_id_exists, make_request, get_url
+from django_stripe import payments, signals, utils
+from django_stripe.logging import stripe_error_log
+from django_stripe.models import StripeEvent
+from django_stripe.webhooks import process_events
 from rest_framework.exceptions import PermissionDenied
 
 
@@ -90,6 +97,90 @@ def test_price_list(client_no_user_and_user_with_and_without_stripe_id, expected
     assert response.data == expected_subscription_prices_unsubscribed
 
 
+@pytest.mark.django_db
+def test_batch(authenticated_client_with_customer_id, expected_subscription_prices_unsubscribed,
+               default_payment_method_from_api, payment_method_from_api, stripe_subscription_product_id,
+               stripe_price_currency):
+    response = make_request(authenticated_client_with_customer_id.post, 'batch', 200, requests=[
+        {'path': get_url('prices'), 'data': {'product': stripe_subscription_product_id, 'currency': stripe_price_currency}},
+        {'path': get_url('payment-methods')},
+        {'method': 'DELETE', 'path': get_url('payment-methods', obj_id='pm_not_existing')},
+        {'path': '/admin/'}
+    ])
+    responses = response.data['responses']
+    assert responses[0] == {'status': 200, 'data': expected_subscription_prices_unsubscribed}
+    assert responses[1] == {'status': 200, 'data': [default_payment_method_from_api, payment_method_from_api]}
+    assert responses[2]['status'] == 500
+    assert responses[3]['status'] == 404
+
+
+@pytest.mark.django_db
+def test_batch_max_product_requests(authenticated_client_with_customer_id, settings, monkeypatch):
+    settings.STRIPE_BATCH_MAX_REQUESTS = 10
+    # A shared pool smaller than the batch must not deadlock sub-requests which wait on it
+    small_executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(utils, "executor", small_executor)
+    monkeypatch.setattr(payments, "executor", small_executor)
+    response = make_request(authenticated_client_with_customer_id.post, 'batch', 200, requests=[
+        {'path': get_url('products')} for _ in range(10)])
+    assert [r['status'] for r in response.data['responses']] == [200] * 10
+    small_executor.shutdown()
+
+
+@pytest.mark.django_db
+def test_batch_unauthenticated(api_client):
+    response = make_request(api_client.post, 'batch', 200, requests=[{'path': get_url('invoices')}])
+    assert response.data['responses'][0]['status'] == 403
+    make_request(api_client.post, 'batch', 400, requests=[])
+
+
+def post_webhook_event(client, secret: str, event_id: str, created: int, status: str):
+    body = json.dumps({'id': event_id, 'type': 'customer.subscription.updated', 'created': created,
+                       'data': {'object': {'id': 'sub_webhook_test', 'customer': 'cus_webhook_test',
+                                           'status': status}}})
+    timestamp = int(time.time())
+    signature = stripe.WebhookSignature._compute_signature(f'{timestamp}.{body}', secret)
+    return client.post(get_url('webhook'), body, content_type='application/json',
+                       HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+
+@pytest.mark.django_db
+def test_webhook_events(settings, api_client):
+    settings.STRIPE_WEBHOOK_SECRET = 'whsec_test'
+    settings.STRIPE_WEBHOOK_PROCESS_IN_BACKGROUND = False
+    assert post_webhook_event(api_client, 'whsec_test', 'evt_2', 200, 'canceled').status_code == 200
+    assert post_webhook_event(api_client, 'whsec_test', 'evt_2', 200, 'canceled').status_code == 200
+    assert post_webhook_event(api_client, 'whsec_test', 'evt_1', 100, 'active').status_code == 200
+    assert post_webhook_event(api_client, 'whsec_wrong', 'evt_3', 300, 'active').status_code == 400
+    assert StripeEvent.objects.count() == 2
+    assert process_events() == {StripeEvent.APPLIED: 2}
+    assert post_webhook_event(api_client, 'whsec_test', 'evt_0', 50, 'active').status_code == 200
+    assert process_events() == {StripeEvent.SKIPPED: 1}
+    assert list(StripeEvent.objects.values_list('event_id', flat=True)) == ['evt_0', 'evt_1', 'evt_2']
+
+
+@pytest.mark.django_db
+def test_price_list_not_modified(client_no_user_and_user_with_and_without_stripe_id, stripe_subscription_product_id):
+    client = client_no_user_and_user_with_and_without_stripe_id
+    response = make_request(client.get, 'prices', 200, product=stripe_subscription_product_id)
+    etag = response['ETag']
+    response = client.get(get_url('prices'), data={'product': stripe_subscription_product_id},
+                          HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert not response.content
+
+
+@pytest.mark.django_db
+def test_price_list_cache_control(api_client, user_with_customer_id, stripe_subscription_product_id):
+    response = make_request(api_client.get, 'prices', 200, product=stripe_subscription_product_id)
+    assert response['Cache-Control'] == 'public, max-age=300'
+    assert 'Cookie' in response['Vary']
+    api_client.force_login(user_with_customer_id)
+    response = make_request(api_client.get, 'prices', 200, product=stripe_subscription_product_id)
+    assert response['Cache-Control'] == 'private'
+
+
 @pytest.mark.django_db
 def test_price_list_subscribed(authenticated_client_with_customer_id, expected_subscription_prices,
                                stripe_subscription_product_id, subscription):
@@ -511,6 +602,28 @@ def test_get_one_subscription(authenticated_client_with_customer_id, subscriptio
     assert response.data == subscription_response
 
 
+@pytest.mark.django_db
+def test_list_subscriptions_fields_expand(authenticated_client_with_customer_id, subscription,
+                                          default_payment_method_id):
+    response = make_request(authenticated_client_with_customer_id.get, "subscriptions", 200,
+                            fields='id,default_payment_method,latest_invoice', expand='latest_invoice')
+    sub = response.data[0]
+    assert tuple(sub.keys()) == ('id', 'default_payment_method', 'latest_invoice')
+    assert sub['id'] == subscription['id']
+    assert sub['default_payment_method'] == default_payment_method_id
+    assert sub['latest_invoice']['subscription'] == subscription['id']
+
+
+@pytest.mark.django_db
+def test_get_one_subscription_expand(authenticated_client_with_customer_id, subscription, default_payment_method_id):
+    response = make_request(authenticated_client_with_customer_id.get, "subscriptions", 200,
+                            url_params={'obj_id': subscription['id']}, expand='default_payment_method',
+                            fields='default_payment_method')
+    assert response.data == {'default_payment_method': stripe.PaymentMethod.retrieve(default_payment_method_id)}
+    make_request(authenticated_client_with_customer_id.get, "subscriptions", 400,
+                 url_params={'obj_id': subscription['id']}, expand='customer')
+
+
 @pytest.mark.django_db
 def test_subscription_list_none_for_user(authenticated_client_second_user, subscription):
     response = make_request(authenticated_client_second_user.get, "subscriptions", 200)
@@ -537,6 +650,13 @@ def test_invoice_list(authenticated_client_with_customer_id, invoice_filters):
                                      "subscription")
 
 
+@pytest.mark.django_db
+def test_invoice_list_deadline_exceeded(authenticated_client_with_customer_id, settings):
+    settings.STRIPE_DEADLINE_SECONDS = 0
+    response = make_request(authenticated_client_with_customer_id.get, "invoices", 500)
+    assert 'deadline was exceeded' in response.data['detail']
+
+
 @pytest.mark.django_db
 def test_invoice_list_none_for_filter(authenticated_client_with_customer_id, subscription):
     response = make_request(authenticated_client_with_customer_id.get, "invoices", 200, status="open")
@@ -581,3 +701,19 @@ def test_non_existing_invoice(authenticated_client_with_customer_id, non_existin
     response = make_request(authenticated_client_with_customer_id.get, "invoices", 500,
                             url_params={'obj_id': non_existing_invoice_id})
     assert response.data == invoice_not_exist_error
+
+
+@pytest.mark.django_db
+def test_non_existing_invoice_logging(authenticated_client_with_customer_id, non_existing_invoice_id, settings, caplog):
+    settings.STRIPE_ERROR_LOG_RATE_LIMIT = 1
+    stripe_error_log.reset()
+    with caplog.at_level(logging.INFO, logger='django.django_stripe'):
+        for i in range(3):
+            make_request(authenticated_client_with_customer_id.get, "invoices", 500,
+                         url_params={'obj_id': non_existing_invoice_id})
+    records = [r for r in caplog.records if hasattr(r, 'stripe_error')]
+    assert len(records) == 1
+    assert records[0].levelno == logging.INFO
+    assert records[0].exc_info is None
+    assert records[0].stripe_error['category'] == 'not_found'
+    assert stripe_error_log.counts[('not_found', 'resource_missing')] == 3
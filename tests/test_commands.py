@@ -0,0 +1,76 @@
+import pytest
+import subscriptions
+import time
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils import timezone
+from tests.django_stripe_testapp.models import User
+from django_stripe.models import StripeEvent, StripeEventCursor, StripeOperation
+from django_stripe.operations import claim_operation, release_stale_operations, send_heartbeat
+from django_stripe.tests import assert_customer_email
+
+
+@pytest.mark.django_db
+def test_sync_customers(user_with_customer_id, user_email, user_alternative_email):
+    User.objects.filter(id=user_with_customer_id.id).update(email=user_alternative_email)
+    call_command('stripe_sync_customers')
+    assert_customer_email(user_with_customer_id, user_alternative_email)
+
+
+@pytest.mark.django_db
+def test_sync_customers_dry_run(user_with_customer_id, user_email, user_alternative_email, capsys):
+    User.objects.filter(id=user_with_customer_id.id).update(email=user_alternative_email)
+    call_command('stripe_sync_customers', dry_run=True)
+    out = capsys.readouterr().out
+    assert f"{user_with_customer_id.stripe_customer_id} (user {user_with_customer_id.id}): email '{user_email}' -> '{user_alternative_email}'" in out
+    assert_customer_email(user_with_customer_id, user_email)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_stripe_worker(settings, user_with_customer_id, user_email, user_alternative_email):
+    settings.STRIPE_USE_OPERATION_QUEUE = True
+    user_with_customer_id.email = user_alternative_email
+    user_with_customer_id.save()
+    user_with_customer_id.first_name = 'Changed'
+    user_with_customer_id.save()
+    op = StripeOperation.objects.get(customer_id=user_with_customer_id.stripe_customer_id)
+    assert op.status == StripeOperation.PENDING
+    assert_customer_email(user_with_customer_id, user_email)
+    call_command('stripe_worker', once=True)
+    op.refresh_from_db()
+    assert op.status == StripeOperation.DONE
+    assert op.attempts == 1
+    assert op.kwargs == {}
+    assert_customer_email(user_with_customer_id, user_alternative_email)
+
+
+@pytest.mark.django_db
+def test_release_stale_operations():
+    op = StripeOperation.objects.create(customer_id='cus_stale', operation='sync_customer_details')
+    assert claim_operation(op)
+    StripeOperation.objects.filter(id=op.id).update(started=timezone.now() - timedelta(seconds=120))
+    assert release_stale_operations(60) == 0
+    StripeOperation.objects.filter(id=op.id).update(heartbeat=timezone.now() - timedelta(seconds=120))
+    send_heartbeat([op])
+    assert release_stale_operations(60) == 0
+    StripeOperation.objects.filter(id=op.id).update(heartbeat=timezone.now() - timedelta(seconds=120))
+    assert release_stale_operations(60) == 1
+    op.refresh_from_db()
+    assert op.status == StripeOperation.PENDING
+
+
+@pytest.mark.django_db
+def test_poll_events(user_with_customer_id, stripe_price_id, default_payment_method_id):
+    call_command('stripe_poll_events', once=True)
+    cursor = StripeEventCursor.objects.get(name='default')
+    subscription = subscriptions.create_subscription(user_with_customer_id, stripe_price_id)
+    for _ in range(10):
+        call_command('stripe_poll_events', once=True)
+        if StripeEvent.objects.filter(object_id=subscription['id']).exists():
+            break
+        time.sleep(1)
+    assert StripeEventCursor.objects.get(name='default').event_id != cursor.event_id
+    assert StripeEvent.objects.get(object_id=subscription['id'], type='customer.subscription.created').status == \
+        StripeEvent.APPLIED
+    user_with_customer_id.refresh_from_db()
+    assert user_with_customer_id.stripe_subscription_id == subscription['id']
@@ -0,0 +1,45 @@
+import os
+import pytest
+import subprocess
+import sys
+from pathlib import Path
+
+
+# Budget for the time taken to import django_stripe.payments and everything it imports, in microseconds.
+# The usual time is around 400ms, most of it taken by stripe and django.contrib.auth. This is about two and a half
+# times that, so it passes on slow machines but fails if a dependency which is slow to import is added.
+IMPORT_TIME_BUDGET_US = 1_000_000
+
+
+@pytest.fixture(scope="session")
+def stripe_subscription_product_id():
+    # Overrides the autouse fixture which creates the product on Stripe, as this test does not use the Stripe API
+    return None
+
+
+@pytest.fixture
+def set_default_product_id():
+    return None
+
+
+def get_django_stripe_import_time() -> int:
+    """
+    Import django_stripe.payments with python -X importtime in a new interpreter and return the cumulative import time
+    in microseconds, including all its dependencies.
+    """
+    code = "import sys, django_stripe.payments; assert 'inflect' not in sys.modules, 'inflect was imported'"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=Path(__file__).parent.parent,
+                            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'tests.settings'},
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-2000:]
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if name.strip() == 'django_stripe.payments':
+                return int(cumulative)
+    raise AssertionError('django_stripe.payments not found in import time output')
+
+
+def test_import_time():
+    import_time = get_django_stripe_import_time()
+    assert 0 < import_time < IMPORT_TIME_BUDGET_US
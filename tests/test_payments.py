@@ -1,10 +1,19 @@
+import time
 import pytest
 import stripe
 import subscriptions
+from unittest import mock
+from django.contrib.auth.models import AnonymousUser
 from django.core import exceptions
-from django_stripe import payments
+from django_stripe import payments, catalog
+from django_stripe.cache import TieredCache
+from django_stripe.checks import check_settings
 from django_stripe import signals
-from django_stripe.tests import assert_customer_id_exists, assert_signal_called, assert_customer_email, assert_customer_description
+from django_stripe.deadline import DeadlineRequestsClient
+from django_stripe.exceptions import PaymentMethodsDetachError
+from django_stripe.warmup import warm_up
+from tests.django_stripe_testapp.models import User
+from django_stripe.tests import signal_mock, assert_customer_id_exists, assert_signal_called, assert_customer_email, assert_customer_description
 
 
 @pytest.mark.django_db
@@ -15,6 +24,29 @@ def test_create_customer(user_with_and_without_customer_id, mock_customer_retrie
     stripe.Customer.retrieve.assert_not_called()
 
 
+@pytest.mark.django_db
+def test_create_customer_already_created(user, monkeypatch):
+    User.objects.filter(id=user.id).update(stripe_customer_id='cus_created_elsewhere')
+    monkeypatch.setattr(stripe.Customer, "create", mock.Mock())
+    payments.create_customer(user)
+    assert user.stripe_customer_id == 'cus_created_elsewhere'
+    stripe.Customer.create.assert_not_called()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_create_customer_on_signup(settings, user_email):
+    settings.STRIPE_CREATE_CUSTOMER_ON_SIGNUP = True
+    user = User.objects.create(id=1, email=user_email, first_name='Test', last_name="User", username="test_user")
+    for _ in range(50):
+        user.refresh_from_db()
+        if user.stripe_customer_id:
+            break
+        time.sleep(0.2)
+    assert user.stripe_customer_id
+    assert_signal_called(signals.new_customer)
+    subscriptions.delete_customer(user)
+
+
 @pytest.mark.django_db
 def test_modify_customer(user_with_customer_id, user_alternative_email):
     payments.modify_customer(user_with_customer_id, email=user_alternative_email)
@@ -71,6 +103,21 @@ def test_subscription_checkout(user_with_and_without_customer_id, stripe_unsubsc
     assert_customer_id_exists(user_with_and_without_customer_id)
 
 
+@pytest.mark.django_db
+def test_subscription_checkout_uses_price_index(user_with_customer_id, stripe_unsubscribed_price_id, monkeypatch):
+    monkeypatch.setattr(stripe.Price, "retrieve", mock.Mock())
+    session = payments.create_subscription_checkout(user_with_customer_id, stripe_unsubscribed_price_id)
+    assert session["id"]
+    stripe.Price.retrieve.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_price_index(stripe_price_id, stripe_subscription_product_id, non_existing_price_id):
+    catalog.refresh_price_index()
+    assert catalog.price_index.get_product(stripe_price_id) == stripe_subscription_product_id
+    assert catalog.price_index.get_product(non_existing_price_id) is None
+
+
 @pytest.mark.django_db
 def test_setup_checkout(user_with_and_without_customer_id):
     session = payments.create_setup_checkout(user_with_and_without_customer_id)
@@ -118,6 +165,70 @@ def test_product_restricted_product(user_with_customer_id, stripe_subscription_p
         payments.retrieve_product(user_with_customer_id, stripe_unsubscribed_product_id)
 
 
+@pytest.mark.django_db
+def test_product_list_catalog_cached(user_with_customer_id, stripe_subscription_product_id, subscription,
+                                     expected_subscription_products_and_prices, monkeypatch):
+    ids = [stripe_subscription_product_id]
+    payments.get_products(None, ids=ids)
+    monkeypatch.setattr(stripe.Product, "list", mock.Mock())
+    monkeypatch.setattr(stripe.Price, "list", mock.Mock())
+    result = payments.get_products(user_with_customer_id, ids=ids)
+    assert result == [expected_subscription_products_and_prices[1]]
+    stripe.Product.list.assert_not_called()
+    stripe.Price.list.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_product_list_single_pass(stripe_subscription_product_id, stripe_unsubscribed_product_id,
+                                  expected_subscription_products_and_prices_unsubscribed, settings, monkeypatch):
+    settings.STRIPE_CATALOG_CACHE_TIMEOUT_SECONDS = 0
+    ids = [stripe_subscription_product_id, stripe_unsubscribed_product_id]
+    monkeypatch.setattr(stripe.Product, "list", mock.Mock(wraps=stripe.Product.list))
+    monkeypatch.setattr(stripe.Price, "list", mock.Mock(wraps=stripe.Price.list))
+    result = payments.get_products(None, ids=ids)
+    assert result == expected_subscription_products_and_prices_unsubscribed
+    stripe.Product.list.assert_called_once()
+    stripe.Price.list.assert_called_once()
+    assert stripe.Price.list.call_args.kwargs['expand'] == ['data.product']
+    stripe.Product.list.reset_mock()
+    result = payments.get_products(None, ids=ids, only_with_prices=True)
+    assert result == expected_subscription_products_and_prices_unsubscribed
+    stripe.Product.list.assert_not_called()
+
+
+def test_load_products_without_prices(monkeypatch):
+    product = {'id': 'prod_no_prices', 'images': [], 'type': 'service', 'name': 'No prices', 'shippable': None,
+               'unit_label': None, 'url': None, 'metadata': {}, 'active': True, 'created': 1}
+    monkeypatch.setattr(stripe.Price, "list", mock.Mock())
+    stripe.Price.list.return_value.auto_paging_iter.return_value = []
+    monkeypatch.setattr(stripe.Product, "list", mock.Mock())
+    stripe.Product.list.return_value.auto_paging_iter.return_value = [product]
+    result = catalog.load_products_and_prices(ids=['prod_no_prices'])
+    assert [(p['id'], p['prices']) for p in result] == [('prod_no_prices', [])]
+    assert stripe.Product.list.call_args.kwargs == {'limit': 100, 'active': True, 'ids': ['prod_no_prices']}
+    assert catalog.load_products_and_prices(ids=['prod_no_prices'], only_with_prices=True) == []
+
+
+def test_load_products_and_prices_overrides_price_kwargs(monkeypatch):
+    monkeypatch.setattr(stripe.Price, "list", mock.Mock())
+    stripe.Price.list.return_value.auto_paging_iter.return_value = []
+    assert catalog.load_products_and_prices(price_kwargs={'currency': 'usd', 'active': False, 'expand': []},
+                                            only_with_prices=True) == []
+    assert stripe.Price.list.call_args.kwargs == {'limit': 100, 'currency': 'usd', 'active': True,
+                                                  'expand': ['data.product']}
+
+
+def test_stripe_deadline(stripe_price_id):
+    assert isinstance(stripe.default_http_client, DeadlineRequestsClient)
+    with payments.stripe_deadline(0):
+        with pytest.raises(stripe.error.APIConnectionError):
+            stripe.Price.retrieve(stripe_price_id)
+    with payments.stripe_deadline(30):
+        assert stripe.default_http_client._timeout <= 30
+        assert stripe.Price.retrieve(stripe_price_id)['id'] == stripe_price_id
+    assert stripe.default_http_client._timeout == 80
+
+
 @pytest.mark.django_db
 def test_product_list_unsubscribed(no_user_and_user_with_and_without_customer_id,
                                    stripe_subscription_product_id,
@@ -208,6 +319,26 @@ def test_detach_all_payment_methods(user_with_customer_id, default_payment_metho
     assert payment_method["customer"] is None
 
 
+@pytest.mark.django_db
+def test_detach_all_payment_methods_partial_failure(user_with_customer_id, payment_method_saved,
+                                                    default_payment_method_saved, monkeypatch):
+    detach = stripe.PaymentMethod.detach
+
+    def detach_or_fail(pm_id):
+        if pm_id == payment_method_saved['id']:
+            raise stripe.error.InvalidRequestError('Cannot detach', 'payment_method')
+        return detach(pm_id)
+
+    monkeypatch.setattr(stripe.PaymentMethod, "detach", detach_or_fail)
+    with pytest.raises(PaymentMethodsDetachError) as exc_info:
+        payments.detach_all_payment_methods(user_with_customer_id, types=["card"])
+    assert list(exc_info.value.errors) == [payment_method_saved['id']]
+    assert [pm['id'] for pm in exc_info.value.detached] == [default_payment_method_saved['id']]
+    assert_signal_called(signals.payment_method_detached)
+    assert signal_mock.call_count == 1
+    assert signal_mock.call_args.kwargs['payment_methods'] == exc_info.value.detached
+
+
 @pytest.mark.django_db
 def test_create_subscription(user_with_customer_id, payment_method_id, default_payment_method_id,
                              stripe_price_id, stripe_subscription_product_id):
@@ -239,6 +370,68 @@ def test_cancel_subscription(user_with_customer_id, subscription, stripe_subscri
     assert response['cancel_at'] is None
 
 
+@pytest.mark.django_db
+def test_subscription_written_to_cache(user_with_customer_id, default_payment_method_id, stripe_price_id,
+                                       stripe_subscription_product_id, django_cache, monkeypatch):
+    cache_key = payments.subscription_info_cache_key(user_with_customer_id, stripe_subscription_product_id)
+    sub = payments.create_subscription(user_with_customer_id, stripe_price_id)
+    assert django_cache.get(cache_key)['sub_id'] == sub['id']
+    assert django_cache.get(cache_key)['price_id'] == stripe_price_id
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    stripe.Subscription.list.assert_not_called()
+    payments.cancel_subscription(user_with_customer_id, sub['id'])
+    assert django_cache.get(cache_key) is None
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is False
+
+
+@pytest.mark.django_db
+def test_subscription_status_stored_on_user(user_with_customer_id, default_payment_method_id, stripe_price_id,
+                                            stripe_subscription_product_id):
+    sub = payments.create_subscription(user_with_customer_id, stripe_price_id)
+    user_with_customer_id.refresh_from_db()
+    assert user_with_customer_id.stripe_subscription_id == sub['id']
+    assert user_with_customer_id.stripe_product_id == stripe_subscription_product_id
+    assert user_with_customer_id.stripe_price_id == stripe_price_id
+    assert user_with_customer_id.stripe_subscription_status == 'active'
+    assert int(user_with_customer_id.stripe_current_period_end.timestamp()) == sub['current_period_end']
+    payments.cancel_subscription(user_with_customer_id, sub['id'])
+    user_with_customer_id.refresh_from_db()
+    assert user_with_customer_id.stripe_subscription_status == 'canceled'
+    assert_signal_called(signals.subscription_cancelled)
+
+
+@pytest.mark.django_db
+def test_is_subscribed_from_user_status(user_with_customer_id, subscription, stripe_subscription_product_id,
+                                        settings, monkeypatch):
+    settings.STRIPE_USE_USER_SUBSCRIPTION_STATUS = True
+    payments.update_user_subscription_status(user_with_customer_id, subscription)
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock())
+    sub_info = payments.is_subscribed_and_cancelled_time(user_with_customer_id, stripe_subscription_product_id)
+    assert sub_info['sub_id'] == subscription['id']
+    assert sub_info['current_period_end'] == subscription['current_period_end']
+    stripe.Subscription.list.assert_not_called()
+    monkeypatch.setattr(user_with_customer_id, "save", mock.Mock())
+    payments.update_user_subscription_status(user_with_customer_id, subscription)
+    user_with_customer_id.save.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_user_status_not_replaced_by_other_product(user_with_customer_id, settings, monkeypatch):
+    settings.STRIPE_USE_USER_SUBSCRIPTION_STATUS = True
+    payments.update_user_subscription_status(user_with_customer_id, {
+        'id': 'sub_other', 'status': 'active', 'plan': {'id': 'price_other', 'product': 'prod_other'},
+        'current_period_end': int(time.time()) + 86400, 'cancel_at': None})
+    monkeypatch.setattr(subscriptions, "is_subscribed_and_cancelled_time", mock.Mock(return_value={
+        'sub_id': 'sub_live', 'cancel_at': None, 'current_period_end': int(time.time()) + 86400,
+        'product_id': 'prod_live', 'price_id': 'price_live'}))
+    monkeypatch.setattr(user_with_customer_id, "save", mock.Mock())
+    sub_info = payments.is_subscribed_and_cancelled_time(user_with_customer_id, 'prod_live')
+    assert sub_info['sub_id'] == 'sub_live'
+    user_with_customer_id.save.assert_not_called()
+    assert user_with_customer_id.stripe_product_id == 'prod_other'
+
+
 @pytest.mark.django_db
 def test_list_subscription(user_with_customer_id, subscription):
     subs = payments.list_customer_resource(user_with_customer_id, stripe.Subscription)
@@ -293,18 +486,145 @@ def test_is_not_subscribed(no_user_and_user_with_and_without_customer_id, stripe
 
 @pytest.mark.django_db
 def test_is_subscribed_with_cache(user_with_customer_id, subscription, stripe_subscription_product_id, django_cache):
-    cache_key = f'is_subscribed_{user_with_customer_id.id}_{stripe_subscription_product_id}'
+    cache_key = f'subscription_info_{user_with_customer_id.id}_{stripe_subscription_product_id}'
     assert django_cache.get(cache_key) is None
     subscribed = payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id)
     assert subscribed is True
-    assert django_cache.get(cache_key) is True
+    assert django_cache.get(cache_key)['sub_id'] == subscription['id']
     subscribed = payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id)
     assert subscribed is True
 
 
+@pytest.mark.django_db
+def test_subscription_info_with_cache(user_with_customer_id, subscription, stripe_subscription_product_id,
+                                      stripe_price_id, django_cache, monkeypatch):
+    sub_info = payments.is_subscribed_and_cancelled_time_with_cache(user_with_customer_id,
+                                                                    stripe_subscription_product_id)
+    assert sub_info['sub_id'] == subscription['id']
+    assert sub_info['current_period_end'] == subscription['current_period_end']
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    product = payments.retrieve_product(user_with_customer_id, stripe_subscription_product_id)
+    assert product['subscription_info'] == {'sub_id': subscription['id'], 'cancel_at': None,
+                                            'current_period_end': subscription['current_period_end']}
+    stripe.Subscription.list.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_get_entitlements(user_with_customer_id, subscription, stripe_subscription_product_id, stripe_price_id,
+                          django_cache, monkeypatch):
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    entitlements = payments.get_entitlements_with_cache(user_with_customer_id)
+    product = entitlements['products'][stripe_subscription_product_id]
+    assert product['sub_id'] == subscription['id']
+    assert product['price_id'] == stripe_price_id
+    assert product['status'] == 'active'
+    assert product['current_period_end'] == subscription['current_period_end']
+    assert entitlements['features'] == product['features']
+    assert payments.get_entitlements_with_cache(user_with_customer_id) == entitlements
+    stripe.Subscription.list.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_get_product_features(settings):
+    settings.STRIPE_FEATURES_METADATA_KEY = 'access'
+    assert payments.get_product_features({'metadata': {'access': 'reports, export,'}}) == ['reports', 'export']
+    assert payments.get_product_features({'metadata': {}}) == []
+
+
+def test_get_entitlements_no_user():
+    assert payments.get_entitlements(None) == {}
+    assert payments.get_entitlements_with_cache(None) == {}
+    assert payments.get_entitlements_with_cache(AnonymousUser()) == {}
+
+
+def test_subscription_cache_timeout(settings):
+    settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS = 30 * 86400
+    settings.STRIPE_SUBSCRIPTION_CACHE_GRACE_SECONDS = 3600
+    now = int(time.time())
+    timeout = payments.get_subscription_cache_timeout([{'cancel_at': None, 'current_period_end': now + 86400}])
+    assert 86400 + 3600 - 5 <= timeout <= 86400 + 3600
+    timeout = payments.get_subscription_cache_timeout([{'cancel_at': now + 600, 'current_period_end': now + 86400}])
+    assert 595 <= timeout <= 600
+    assert payments.get_subscription_cache_timeout([{'cancel_at': None, 'current_period_end': now + 90 * 86400}]) == 30 * 86400
+    assert payments.get_subscription_cache_timeout([{'cancel_at': now - 1, 'current_period_end': now + 86400}]) == 0
+    assert payments.get_subscription_cache_timeout([]) == 30 * 86400
+
+
+@pytest.mark.django_db
+def test_get_entitlements_not_subscribed_cache_timeout(user, settings, django_cache, monkeypatch):
+    settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS = 30 * 86400
+    monkeypatch.setattr(payments, "get_entitlements", mock.Mock(return_value={'products': {}, 'features': []}))
+    settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS = 0
+    assert payments.get_entitlements_with_cache(user) == {'products': {}, 'features': []}
+    assert django_cache.get(payments.entitlements_cache_key(user)) is None
+    settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS = 60
+    monkeypatch.setattr(payments.subscription_cache, "set", mock.Mock(wraps=payments.subscription_cache.set))
+    payments.get_entitlements_with_cache(user)
+    assert payments.subscription_cache.set.call_args.kwargs['timeout'] == 60
+
+
+@pytest.mark.django_db
+def test_subscription_refreshed_ahead(user_with_customer_id, subscription, stripe_subscription_product_id,
+                                      django_cache, settings, monkeypatch):
+    settings.STRIPE_SUBSCRIPTION_CHECK_CACHE_TIMEOUT_SECONDS = 60
+    settings.STRIPE_SUBSCRIPTION_CACHE_REFRESH_AHEAD_SECONDS = 10
+    settings.STRIPE_SUBSCRIPTION_CACHE_STALE_SECONDS = 60
+    cache_key = payments.subscription_info_cache_key(user_with_customer_id, stripe_subscription_product_id)
+    sub_info = payments.is_subscribed_and_cancelled_time_with_cache(user_with_customer_id,
+                                                                    stripe_subscription_product_id)
+    assert 'refresh_at' not in sub_info
+    assert 40 <= django_cache.get(cache_key)['refresh_at'] - time.time() <= 50
+    django_cache.set(cache_key, {**django_cache.get(cache_key), 'refresh_at': time.time() - 1})
+    monkeypatch.setattr(payments, "run_in_background", mock.Mock())
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    stripe.Subscription.list.assert_not_called()
+    payments.run_in_background.assert_called_once()
+    f, *args = payments.run_in_background.call_args.args
+    f(*args)
+    stripe.Subscription.list.assert_called_once()
+    assert django_cache.get(cache_key)['refresh_at'] > time.time()
+    assert django_cache.get(f'{cache_key}_refreshing') is None
+
+
+@pytest.mark.django_db
+def test_is_subscribed_with_local_cache(user_with_customer_id, subscription, stripe_subscription_product_id,
+                                        django_cache, settings, monkeypatch):
+    settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE = 10
+    cache_key = f'subscription_info_{user_with_customer_id.id}_{stripe_subscription_product_id}'
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    django_cache.delete(cache_key)
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    stripe.Subscription.list.assert_not_called()
+    payments.subscription_cache.invalidate_local()
+    assert payments.is_subscribed_with_cache(user_with_customer_id, stripe_subscription_product_id) is True
+    stripe.Subscription.list.assert_called_once()
+    payments.subscription_cache.invalidate_local()
+
+
+def test_local_cache_coherent_between_processes(django_cache, settings):
+    settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SIZE = 10
+    settings.STRIPE_SUBSCRIPTION_LOCAL_CACHE_SYNC_SECONDS = 0
+    process1 = TieredCache(payments._get_subscription_cache, 'test_generation')
+    process2 = TieredCache(payments._get_subscription_cache, 'test_generation')
+    process1.set('key', 'subscribed', timeout=60)
+    assert process2.get('key') == 'subscribed'
+    process1.set('key', 'cancelled', timeout=60)
+    assert process2.get('key') == 'cancelled'
+    process1.delete('key')
+    assert process2.get('key') is None
+    process1.set('key', 'expiring', timeout=1)
+    assert process2.get('key') == 'expiring'
+    time.sleep(1.1)
+    assert process2.get('key') is None
+
+
 @pytest.mark.django_db
 def test_user_is_not_subscribed_with_cache(user_with_and_without_customer_id, django_cache, stripe_subscription_product_id):
-    cache_key = f'is_subscribed_{user_with_and_without_customer_id.id}_{stripe_subscription_product_id}'
+    cache_key = f'subscription_info_{user_with_and_without_customer_id.id}_{stripe_subscription_product_id}'
     subscribed = payments.is_subscribed_with_cache(user_with_and_without_customer_id,
                                                    product_id=stripe_subscription_product_id)
     assert subscribed is False
@@ -312,3 +632,17 @@ def test_user_is_not_subscribed_with_cache(user_with_and_without_customer_id, dj
     subscribed = payments.is_subscribed_with_cache(user_with_and_without_customer_id,
                                                    product_id=stripe_subscription_product_id)
     assert subscribed is False
+
+
+def test_warm_up(settings):
+    settings.STRIPE_PRICE_INDEX_REFRESH_SECONDS = 300
+    catalog.price_index._loaded_at = None
+    assert warm_up() > 0
+    assert catalog.price_index.age() is not None
+
+
+def test_check_settings(settings):
+    settings.STRIPE_SECRET_KEY = 'sk_live_abc'
+    settings.STRIPE_PUBLISHABLE_KEY = 'pk_test_abc'
+    settings.STRIPE_CATALOG_CACHE_NAME = 'missing'
+    assert [m.id for m in check_settings()] == ['django_stripe.E003', 'django_stripe.E005']
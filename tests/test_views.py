@@ -1,5 +1,11 @@
 import pytest
+import stripe
+from unittest import mock
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
 from django_stripe import signals
+from django_stripe.decorators import subscription_required
+from django_stripe.middleware import SubscriptionRequiredMiddleware
 from django_stripe.tests import make_request, get_expected_checkout_html
 
 
@@ -59,3 +65,75 @@ def test_billing_portal(authenticated_client, billing_portal_data):
                             signal=signals.billing_portal_created)
     billing_portal_session = billing_portal_data['session']
     assert response.url == billing_portal_session['url']
+
+
+@pytest.mark.django_db
+def test_subscription_portal_catalog_cached(authenticated_client, stripe_subscription_product_id, user_email,
+                                            monkeypatch):
+    make_request(authenticated_client.get, 'subscription-portal', 200)
+    monkeypatch.setattr(stripe.Product, "retrieve", mock.Mock())
+    monkeypatch.setattr(stripe.Price, "list", mock.Mock())
+    response = make_request(authenticated_client.get, 'subscription-portal', 200)
+    assert response.context['product']['id'] == stripe_subscription_product_id
+    assert response.context['js_config']['user_email'] == user_email
+    stripe.Product.retrieve.assert_not_called()
+    stripe.Price.list.assert_not_called()
+
+
+@subscription_required
+def premium_view(request):
+    return HttpResponse('premium')
+
+
+@pytest.mark.django_db
+def test_subscription_required(rf, user_with_customer_id, subscription, django_cache):
+    request = rf.get('/premium/')
+    request.user = user_with_customer_id
+    response = premium_view(request)
+    assert response.status_code == 200
+    assert response.content == b'premium'
+
+
+@pytest.mark.django_db
+def test_subscription_required_not_subscribed(rf, user_with_customer_id, django_cache, settings):
+    request = rf.get('/premium/')
+    request.user = user_with_customer_id
+    assert premium_view(request).status_code == 403
+    settings.STRIPE_SUBSCRIPTION_REQUIRED_REDIRECT_URL = 'subscription-portal'
+    request = rf.get('/premium/')
+    request.user = user_with_customer_id
+    response = premium_view(request)
+    assert response.status_code == 302
+    assert response.url == '/'
+    request = rf.get('/premium/')
+    request.user = AnonymousUser()
+    response = premium_view(request)
+    assert response.status_code == 302
+    assert response.url.startswith(settings.LOGIN_URL)
+
+
+@pytest.mark.django_db
+def test_subscription_required_allowed_access_until(rf, user_allowed_access_until, monkeypatch):
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock())
+    request = rf.get('/premium/')
+    request.user = user_allowed_access_until
+    assert premium_view(request).status_code == 200
+    stripe.Subscription.list.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_subscription_required_middleware(rf, user_with_customer_id, stripe_subscription_product_id, django_cache,
+                                          settings, monkeypatch):
+    settings.STRIPE_SUBSCRIPTION_REQUIRED_PATHS = {'/premium/': stripe_subscription_product_id}
+    settings.STRIPE_SUBSCRIPTION_NEGATIVE_CACHE_TIMEOUT_SECONDS = 60
+    monkeypatch.setattr(stripe.Subscription, "list", mock.Mock(wraps=stripe.Subscription.list))
+    middleware = SubscriptionRequiredMiddleware(premium_view)
+    request = rf.get('/other/')
+    request.user = user_with_customer_id
+    assert middleware(request).status_code == 200
+    stripe.Subscription.list.assert_not_called()
+    for i in range(2):
+        request = rf.get('/premium/page/')
+        request.user = user_with_customer_id
+        assert middleware(request).status_code == 403
+    stripe.Subscription.list.assert_called_once()